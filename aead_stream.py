@@ -0,0 +1,85 @@
+import struct
+from typing import Iterator, NamedTuple, Tuple
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from compression import compress_block, decompress_block
+
+# Format v2: every segment payload starts with the stream header and holds
+# whole AES-GCM chunks, so each segment can be verified and decrypted on its
+# own and in any order.
+STREAM_SIGNATURE = b'ENCRYPTED_FILE_v2.0'
+SALT_SIZE = 16
+
+# signature, salt, plaintext block size
+STREAM_HEADER_STRUCT = struct.Struct(f'>{len(STREAM_SIGNATURE)}s{SALT_SIZE}sI')
+
+# chunk index, codec, flags, ciphertext length (including the GCM tag)
+CHUNK_HEADER_STRUCT = struct.Struct('>QBBI')
+
+# Set on the last chunk of a stream so truncation is detected
+CHUNK_FLAG_FINAL = 0x01
+
+class StreamHeader(NamedTuple):
+    salt: bytes
+    block_size: int
+
+class Chunk(NamedTuple):
+    index: int
+    codec: int
+    flags: int
+    header: bytes
+    ciphertext: bytes
+
+    @property
+    def is_final(self) -> bool:
+        return bool(self.flags & CHUNK_FLAG_FINAL)
+
+def pack_stream_header(salt: bytes, block_size: int) -> bytes:
+    return STREAM_HEADER_STRUCT.pack(STREAM_SIGNATURE, salt, block_size)
+
+def parse_stream_header(payload: bytes) -> Tuple[StreamHeader, int]:
+    """Parse the stream header at the start of a segment payload, returning it and the body offset"""
+    if len(payload) < STREAM_HEADER_STRUCT.size:
+        raise ValueError("Truncated stream header")
+    signature, salt, block_size = STREAM_HEADER_STRUCT.unpack_from(payload)
+    if signature != STREAM_SIGNATURE:
+        raise ValueError("Invalid stream signature")
+    return StreamHeader(salt, block_size), STREAM_HEADER_STRUCT.size
+
+def chunk_nonce(index: int) -> bytes:
+    """96-bit nonce from the chunk index; unique because every file has its own key"""
+    return b'\x00' * 4 + struct.pack('>Q', index)
+
+def seal_chunk(key: bytes, stream_header: bytes, index: int, block: bytes, final: bool,
+               policy: str = 'balanced', skip_compression: bool = False) -> bytes:
+    """Compress and encrypt one block into an authenticated chunk.
+
+    The stream header and chunk header are bound in as associated data, so
+    a chunk cannot be moved to another file, renumbered or have its codec
+    or final flag changed without failing authentication.
+    """
+    codec, payload = compress_block(block, policy, skip_compression)
+    flags = CHUNK_FLAG_FINAL if final else 0
+    header = CHUNK_HEADER_STRUCT.pack(index, codec, flags, len(payload) + 16)
+    ciphertext = AESGCM(key).encrypt(chunk_nonce(index), payload, stream_header + header)
+    return header + ciphertext
+
+def open_chunk(key: bytes, stream_header: bytes, chunk: Chunk) -> bytes:
+    """Verify, decrypt and decompress one chunk"""
+    payload = AESGCM(key).decrypt(chunk_nonce(chunk.index), chunk.ciphertext, stream_header + chunk.header)
+    return decompress_block(chunk.codec, payload)
+
+def iter_chunks(payload: bytes, offset: int) -> Iterator[Chunk]:
+    """Split a segment body into its chunks"""
+    while offset < len(payload):
+        if offset + CHUNK_HEADER_STRUCT.size > len(payload):
+            raise ValueError("Truncated chunk header")
+        header = payload[offset:offset + CHUNK_HEADER_STRUCT.size]
+        index, codec, flags, length = CHUNK_HEADER_STRUCT.unpack(header)
+        offset += CHUNK_HEADER_STRUCT.size
+
+        ciphertext = payload[offset:offset + length]
+        if len(ciphertext) != length:
+            raise ValueError(f"Truncated chunk {index}")
+        offset += length
+
+        yield Chunk(index, codec, flags, header, ciphertext)
@@ -0,0 +1,145 @@
+import time
+from typing import Any, Dict, List, Optional
+from sqlite_connection import ThreadLocalConnection
+
+class AttachmentIndex:
+    """Local SQLite index of conversations, messages and their attachments.
+
+    Each conversation keeps the updated_time it had when it was last synced
+    (its watermark) and the newest message created_time seen, so a sync
+    only fetches conversations that changed and only their new messages.
+    Attachment names are indexed case-insensitively for prefix lookups
+    such as 'enc_<batch_id>'.
+    """
+
+    def __init__(self, path: str = 'attachments.db'):
+        self.path = path
+        self._connection = ThreadLocalConnection(path)
+        with self._connection() as conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    conversation_id TEXT PRIMARY KEY,
+                    updated_time TEXT,
+                    newest_message_time TEXT,
+                    synced_time REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id TEXT PRIMARY KEY,
+                    conversation_id TEXT NOT NULL,
+                    created_time TEXT
+                );
+                CREATE TABLE IF NOT EXISTS attachments (
+                    message_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    name_key TEXT NOT NULL,
+                    conversation_id TEXT NOT NULL,
+                    created_time TEXT,
+                    from_name TEXT,
+                    message_text TEXT,
+                    type TEXT,
+                    file_url TEXT,
+                    mime_type TEXT,
+                    size INTEGER,
+                    PRIMARY KEY (message_id, name)
+                );
+                CREATE INDEX IF NOT EXISTS idx_attachments_name ON attachments (name_key);
+                CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, created_time);
+            ''')
+
+    def conversation_state(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """Watermarks of a conversation, or None if it was never synced"""
+        row = self._connection().execute(
+            'SELECT updated_time, newest_message_time FROM conversations WHERE conversation_id = ?',
+            (conversation_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'updated_time': row[0], 'newest_message_time': row[1]}
+
+    def add_messages(self, conversation_id: str, updated_time: str, messages: List[Dict[str, Any]],
+                     attachments: List[Dict[str, Any]]):
+        """Store newly fetched messages and attachments and advance the conversation's watermarks"""
+        with self._connection() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO messages (message_id, conversation_id, created_time) VALUES (?, ?, ?)',
+                [(m.get('id'), conversation_id, m.get('created_time')) for m in messages if m.get('id')]
+            )
+            conn.executemany(
+                '''INSERT OR REPLACE INTO attachments
+                   (message_id, name, name_key, conversation_id, created_time, from_name, message_text,
+                    type, file_url, mime_type, size)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                [self._attachment_row(a, conversation_id) for a in attachments]
+            )
+            newest = max((m.get('created_time') or '' for m in messages), default='')
+            conn.execute(
+                '''INSERT INTO conversations (conversation_id, updated_time, newest_message_time, synced_time)
+                   VALUES (?, ?, ?, ?)
+                   ON CONFLICT (conversation_id) DO UPDATE SET
+                       updated_time = excluded.updated_time,
+                       newest_message_time = MAX(COALESCE(newest_message_time, ''), excluded.newest_message_time),
+                       synced_time = excluded.synced_time''',
+                (conversation_id, updated_time, newest, time.time())
+            )
+
+    def update_attachment(self, attachment: Dict[str, Any]):
+        """Replace one attachment, e.g. after its file_url was refreshed"""
+        with self._connection() as conn:
+            conn.execute(
+                '''INSERT OR REPLACE INTO attachments
+                   (message_id, name, name_key, conversation_id, created_time, from_name, message_text,
+                    type, file_url, mime_type, size)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                self._attachment_row(attachment, attachment.get('conversation_id', ''))
+            )
+
+    def find_by_name(self, pattern: str) -> List[Dict[str, Any]]:
+        """Attachments whose name starts with pattern (case-insensitive), newest first.
+
+        The prefix lookup is a range scan on the name index; only when no
+        name starts with the pattern are names containing it searched.
+        """
+        key = pattern.lower()
+        conn = self._connection()
+        rows = conn.execute(
+            'SELECT * FROM attachments WHERE name_key >= ? AND name_key < ? ORDER BY created_time DESC',
+            (key, key + '￿')
+        ).fetchall()
+        if not rows:
+            rows = conn.execute(
+                'SELECT * FROM attachments WHERE instr(name_key, ?) > 0 ORDER BY created_time DESC', (key,)
+            ).fetchall()
+
+        columns = [c[1] for c in conn.execute('PRAGMA table_info(attachments)')]
+        return [self._attachment_dict(dict(zip(columns, row))) for row in rows]
+
+    def _attachment_row(self, attachment: Dict[str, Any], conversation_id: str):
+        name = attachment.get('name', 'attachment')
+        return (
+            attachment.get('message_id'),
+            name,
+            name.lower(),
+            conversation_id,
+            attachment.get('created_time'),
+            attachment.get('from'),
+            attachment.get('message_text', ''),
+            attachment.get('type'),
+            attachment.get('file_url'),
+            attachment.get('mime_type', ''),
+            attachment.get('size', 0),
+        )
+
+    def _attachment_dict(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        """Same shape as FacebookAttachmentDownloader.message_attachments() entries"""
+        return {
+            'message_id': row['message_id'],
+            'created_time': row['created_time'],
+            'from': row['from_name'],
+            'message_text': row['message_text'],
+            'type': row['type'],
+            'file_url': row['file_url'],
+            'name': row['name'],
+            'mime_type': row['mime_type'],
+            'size': row['size'],
+            'conversation_id': row['conversation_id'],
+        }
@@ -3,85 +3,154 @@ import json
 import requests
 import time
 import glob
-import base64
 import zlib
 import re
-from typing import Dict, List, Any, Optional
+import collections
+import itertools
+import queue
+import multiprocessing
+import concurrent.futures
+import threading
+from typing import Callable, Dict, List, Any, Optional, Tuple
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+from key_derivation import derive_password_key, derive_aead_key
+from aead_stream import STREAM_SIGNATURE, iter_chunks, open_chunk, parse_stream_header
+from segment_container import (
+    is_manifest_name, is_parity_name, read_header, read_manifest, read_parity_header, read_segment, verify_segment
+)
+import erasure
+from rate_limiter import shared_rate_limiter
+from http_transport import create_session
+from graph_batch import execute_batch, graph_request
+from attachment_index import AttachmentIndex
+from range_downloader import DownloadError
 from config import *
 
 # Configuration
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
 
+# Largest piece of legacy v1.0 output decompressed and written at once
+DECOMPRESS_BLOCK_SIZE = 1024 * 1024
+
+def open_aead_chunk(key, stream_header, chunk):
+    """Verify, decrypt and decompress one format v2 chunk (runs in worker processes)"""
+    try:
+        return open_chunk(key, stream_header, chunk)
+    except InvalidTag:
+        raise ValueError(f"Chunk {chunk.index} failed authentication (corrupted segment or wrong password)")
+
+class SegmentStream:
+    """Segments handed over as their downloads complete, read back in part order"""
+    
+    def __init__(self, expected_parts: Optional[int] = None):
+        self.expected_parts = expected_parts
+        self.arrivals = queue.Queue()
+    
+    def add(self, file_path: str):
+        """Hand over a downloaded segment (called from the download threads)"""
+        self.arrivals.put(file_path)
+    
+    def close(self):
+        """Mark the end of the downloads"""
+        self.arrivals.put(None)
+    
+    def __iter__(self):
+        window = {}
+        next_index = 1
+        expected_offset = 0
+        last_header = None
+        
+        while True:
+            file_path = self.arrivals.get()
+            if file_path is None:
+                break
+            
+            header, part_index = self._part_index(file_path)
+            # A segment that arrives early waits here (only its path is kept) until the parts before it are in
+            if part_index >= next_index:
+                window[part_index] = (file_path, header)
+            
+            while next_index in window:
+                file_path, header = window.pop(next_index)
+                # Binary container segments also record where they belong in the stream
+                if header is not None:
+                    if header.offset != expected_offset:
+                        raise ValueError(f"Missing data before part {header.part_index} (offset {expected_offset})")
+                    expected_offset += header.length
+                    last_header = header
+                
+                print(f"Reading segment: {file_path}")
+                yield read_segment(file_path)[1]
+                next_index += 1
+        
+        if window or (self.expected_parts and next_index <= self.expected_parts):
+            raise ValueError(f"Missing part {next_index}")
+        if last_header is not None and not last_header.is_final:
+            raise ValueError(f"Missing parts after part {last_header.part_index}")
+    
+    def _part_index(self, file_path: str):
+        """Part index from the container header, or from the _partNNN file name for legacy segments"""
+        with open(file_path, 'rb') as f:
+            header = read_header(f)
+        if header is not None:
+            return header, header.part_index
+        
+        match = re.search(r'_part(\d+)', os.path.basename(file_path))
+        if not match:
+            raise ValueError(f"Cannot tell the part number of {file_path}")
+        return None, int(match.group(1))
+
 class FileDecryptor:
-    def __init__(self):
+    def __init__(self, workers=1):
+        self.workers = workers or os.cpu_count() or 1
         self.file_signature = b'ENCRYPTED_FILE_v1.0'
+        self._pool = None
     
     def derive_key(self, password, salt):
         """Derive encryption key from password using PBKDF2"""
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-        )
-        return base64.urlsafe_b64encode(kdf.derive(password.encode()))
+        return derive_password_key(password, salt)
     
     def decrypt_file(self, input_pattern, output_file, password):
         """Decrypt segmented files back to original"""
+        # Find all segment files
+        segment_files = sorted(glob.glob(input_pattern))
+        
+        if not segment_files:
+            print("No segment files found!")
+            return False
+        
         try:
-            # Find all segment files
-            segment_files = sorted(glob.glob(input_pattern))
-            
-            if not segment_files:
+            segment_files = self._order_segments(segment_files)
+        except Exception as e:
+            print(f"Decryption error: {e}")
+            return False
+        
+        return self.decrypt_segments(self._iter_payloads(segment_files), output_file, password)
+    
+    def decrypt_segments(self, payloads, output_file, password):
+        """Decrypt segment payloads given in stream order, consuming each one as soon as it is produced"""
+        try:
+            payloads = iter(payloads)
+            first_payload = next(payloads, None)
+            if first_payload is None:
                 print("No segment files found!")
                 return False
+            payloads = itertools.chain([first_payload], payloads)
             
-            # Read all segments
-            combined_data = b''
-            for segment_file in segment_files:
-                print(f"Reading segment: {segment_file}")
-                
-                # Extract base64 data from PDF-like file
-                with open(segment_file, 'rb') as f:
-                    content = f.read()
-                
-                # Find the stream content
-                stream_start = content.find(b'stream\n') + 7
-                stream_end = content.find(b'\nendstream', stream_start)
-                
-                if stream_start == -1 or stream_end == -1:
-                    print(f"Invalid segment file format: {segment_file}")
-                    return False
-                
-                base64_data = content[stream_start:stream_end].strip()
-                chunk_data = base64.b64decode(base64_data)
-                combined_data += chunk_data
+            # Format v2 segments are self-contained AES-GCM chunk streams
+            if first_payload.startswith(STREAM_SIGNATURE):
+                self.decrypt_aead_segments(payloads, output_file, password)
+                print(f"Decryption complete! File saved as: {output_file}")
+                return True
             
             # Verify file signature
-            if not combined_data.startswith(self.file_signature):
+            if not first_payload.startswith(self.file_signature):
                 print("Invalid file signature! File may be corrupted or wrong password.")
                 return False
             
-            # Extract salt and encrypted data
-            salt = combined_data[len(self.file_signature):len(self.file_signature)+16]
-            encrypted_data = combined_data[len(self.file_signature)+16:]
-            
-            # Derive key and decrypt
-            key = self.derive_key(password, salt)
-            fernet = Fernet(key)
-            
-            # Decrypt and decompress
-            compressed_data = fernet.decrypt(encrypted_data)
-            original_data = zlib.decompress(compressed_data)
-            
-            # Write original file
-            with open(output_file, 'wb') as f:
-                f.write(original_data)
-            
+            self.decrypt_legacy(payloads, output_file, password)
             print(f"Decryption complete! File saved as: {output_file}")
             return True
             
@@ -89,40 +158,171 @@ class FileDecryptor:
             print(f"Decryption error: {e}")
             return False
 
+    def _order_segments(self, segment_files):
+        """Return segment files in stream order, reading only their headers"""
+        headers = []
+        for segment_file in segment_files:
+            with open(segment_file, 'rb') as f:
+                headers.append((read_header(f), segment_file))
+        
+        # Legacy PDF segments have no header and are taken in file name order
+        if any(header is None for header, _ in headers):
+            return segment_files
+        
+        headers.sort(key=lambda segment: segment[0].part_index)
+        expected_offset = 0
+        for header, _ in headers:
+            if header.offset != expected_offset:
+                raise ValueError(f"Missing data before part {header.part_index} (offset {expected_offset})")
+            expected_offset += header.length
+        
+        if not headers[-1][0].is_final:
+            raise ValueError(f"Missing parts after part {headers[-1][0].part_index}")
+        
+        return [segment_file for _, segment_file in headers]
+    
+    def _iter_payloads(self, segment_files):
+        """Yield segment payloads one at a time, so only the current segment is held in memory"""
+        for segment_file in segment_files:
+            print(f"Reading segment: {segment_file}")
+            yield read_segment(segment_file)[1]
+    
+    def decrypt_legacy(self, payloads, output_file, password):
+        """Decrypt a v1.0 file: one Fernet token over the zlib-compressed file"""
+        # The token can only be authenticated whole; the output is still decompressed incrementally
+        encrypted_data = b''.join(payloads)
+        
+        # Extract salt and encrypted data
+        salt = encrypted_data[len(self.file_signature):len(self.file_signature)+16]
+        key = self.derive_key(password, salt)
+        compressed_data = Fernet(key).decrypt(encrypted_data[len(self.file_signature)+16:])
+        del encrypted_data
+        
+        # Bound each write to DECOMPRESS_BLOCK_SIZE however well the data compressed
+        decompressor = zlib.decompressobj()
+        view = memoryview(compressed_data)
+        with open(output_file, 'wb') as f:
+            for start in range(0, len(view), DECOMPRESS_BLOCK_SIZE):
+                pending = view[start:start + DECOMPRESS_BLOCK_SIZE]
+                while pending:
+                    f.write(decompressor.decompress(pending, DECOMPRESS_BLOCK_SIZE))
+                    pending = decompressor.unconsumed_tail
+            f.write(decompressor.flush())
+        
+        if not decompressor.eof:
+            raise ValueError("Compressed data is truncated")
+    
+    def decrypt_aead_segments(self, payloads, output_file, password):
+        """Decrypt format v2 segments"""
+        stream = {}
+        seen_indices = set()
+        final_index = None
+        
+        def calls():
+            for payload in payloads:
+                stream_header, body_offset = parse_stream_header(payload)
+                if not stream:
+                    stream['header'] = stream_header
+                    stream['key'] = derive_aead_key(password, stream_header.salt)
+                # Another file's chunks would authenticate under their own key, so the first header is pinned
+                elif stream_header != stream['header']:
+                    raise ValueError("Segment belongs to a different encrypted file (stream header mismatch)")
+                for chunk in iter_chunks(payload, body_offset):
+                    yield stream['key'], payload[:body_offset], chunk
+        
+        with open(output_file, 'wb') as f:
+            for (_, _, chunk), plaintext in self._map_ordered(open_aead_chunk, calls()):
+                # Every chunk is authenticated on its own and has a fixed place, so segments may come in any order
+                f.seek(chunk.index * stream['header'].block_size)
+                f.write(plaintext)
+                seen_indices.add(chunk.index)
+                if chunk.is_final:
+                    final_index = chunk.index
+        
+        if final_index is None:
+            raise ValueError("Final chunk missing, file is truncated")
+        missing = set(range(final_index + 1)) - seen_indices
+        if missing:
+            raise ValueError(f"Missing {len(missing)} chunk(s), first missing chunk is {min(missing)}")
+    
+    def _map_ordered(self, func, calls):
+        """Yield (args, func(*args)) in order, spreading calls over a process pool when workers > 1"""
+        if self.workers <= 1:
+            for args in calls:
+                yield args, func(*args)
+            return
+        
+        if self._pool is None:
+            # Forking would copy the locks held by this process's other threads into the workers
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver')
+            )
+        
+        pending = collections.deque()
+        for args in calls:
+            pending.append((args, self._pool.submit(func, *args)))
+            if len(pending) >= self.workers * 2:
+                args, future = pending.popleft()
+                yield args, future.result()
+        while pending:
+            args, future = pending.popleft()
+            yield args, future.result()
+
+class DownloadProgress:
+    """Aggregate progress of concurrent downloads, reported every 10% of the total"""
+    
+    def __init__(self, total_bytes: int, file_count: int):
+        self.total_bytes = total_bytes
+        self.file_count = file_count
+        self.downloaded_bytes = 0
+        self.finished_files = 0
+        self.reported = 0
+        self.lock = threading.Lock()
+    
+    def add(self, byte_count: int):
+        with self.lock:
+            self.downloaded_bytes += byte_count
+            if self.total_bytes <= 0:
+                return
+            percent = min(100, self.downloaded_bytes * 100 // self.total_bytes)
+            if percent >= self.reported + 10:
+                self.reported = percent - percent % 10
+                print(f"Download progress: {percent}% ({self.downloaded_bytes}/{self.total_bytes} bytes, "
+                      f"{self.finished_files}/{self.file_count} files)")
+    
+    def file_done(self):
+        with self.lock:
+            self.finished_files += 1
+
 class FacebookAttachmentDownloader:
-    def __init__(self, access_token: str):
+    def __init__(self, access_token: str, index_path: Optional[str] = None):
         self.access_token = access_token
-        self.base_url = "https://graph.facebook.com/v19.0"
-        self.session = requests.Session()
+        self.base_url = GRAPH_API_URL
+        # Pooled connections for the concurrent segment downloads plus Graph reads
+        self.session = create_session(pool_size=SEGMENT_DOWNLOAD_WORKERS + 2)
+        self.host_semaphores = {}
+        self.host_lock = threading.Lock()
+        self.rate_limiter = shared_rate_limiter(GRAPH_API_RATE_LIMITS)
+        # Searches are served from the local index when one is configured
+        self.index = AttachmentIndex(index_path) if index_path else None
     
     def make_api_request(self, url: str, params: Dict) -> Dict[str, Any]:
         """Make API request with error handling and retry logic"""
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                if 'access_token' not in params:
-                    params['access_token'] = self.access_token
-                    
-                response = self.session.get(url, params=params, timeout=30)
-                
-                if response.status_code == 429:  # Rate limited
-                    wait_time = 2 ** attempt
-                    print(f"Rate limited. Waiting {wait_time} seconds before retry...")
-                    time.sleep(wait_time)
-                    continue
-                    
-                if response.status_code != 200:
-                    print(f"API Error {response.status_code}: {response.text}")
-                    return {'error': f'HTTP {response.status_code}: {response.text}'}
-                    
-                return response.json()
-            except requests.exceptions.RequestException as e:
-                if attempt == max_retries - 1:
-                    print(f"Request failed after {max_retries} attempts: {e}")
-                    return {'error': str(e)}
-                wait_time = 2 ** attempt
-                time.sleep(wait_time)
-        return {'error': 'Max retries exceeded'}
+        if 'access_token' not in params:
+            params['access_token'] = self.access_token
+        return graph_request(self.session, self.rate_limiter, url, params)
+    
+    def batch_request(self, calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Run many read calls through the Graph batch endpoint, one result per call in order"""
+        return execute_batch(
+            self.session,
+            self.rate_limiter,
+            self.base_url,
+            self.access_token,
+            calls,
+            'read',
+            batch_size=GRAPH_BATCH_SIZE
+        )
     
     def get_conversations(self, limit: int = 20, after: str = None) -> Dict[str, Any]:
         """Get list of conversations with pagination support"""
@@ -166,9 +366,6 @@ class FacebookAttachmentDownloader:
             after = paging.get('cursors', {}).get('after')
             if not after:
                 break
-                
-            # Be nice to the API
-            time.sleep(1)
         
         return all_conversations
     
@@ -176,11 +373,7 @@ class FacebookAttachmentDownloader:
         """Get messages from a conversation"""
         url = f"{self.base_url}/{conversation_id}/messages"
         
-        # Use the working field format with curly braces
-        params = {
-            'fields': 'id,created_time,from,message,attachments{type,file_url,name,size,mime_type}',
-            'limit': limit
-        }
+        params = self.message_params(limit)
         
         if after:
             params['after'] = after
@@ -188,235 +381,657 @@ class FacebookAttachmentDownloader:
         print(f"Fetching messages from conversation {conversation_id}...")
         return self.make_api_request(url, params)
     
-    def get_all_messages(self, conversation_id: str, limit: int = 1000) -> List[Dict]:
-        """Get all messages from a conversation with pagination"""
-        all_messages = []
+    def message_params(self, limit: int) -> Dict[str, Any]:
+        # Use the working field format with curly braces
+        return {
+            'fields': 'id,created_time,from,message,attachments{type,file_url,name,size,mime_type}',
+            'limit': limit
+        }
+    
+    def get_first_message_pages(self, conversation_ids: List[str], limit: int = 100) -> List[Dict[str, Any]]:
+        """Fetch the first page of messages of many conversations in batch requests"""
+        print(f"Fetching messages from {len(conversation_ids)} conversations...")
+        query = urlencode(self.message_params(limit))
+        calls = [
+            {'method': 'GET', 'relative_url': f"{conversation_id}/messages?{query}"}
+            for conversation_id in conversation_ids
+        ]
+        return self.batch_request(calls)
+    
+    def iter_message_pages(self, conversation_id: str, limit: int = 1000,
+                           first_page: Optional[Dict[str, Any]] = None):
+        """Yield a conversation's messages page by page, newest first; the next page is only fetched when asked for"""
+        fetched = 0
         after = None
         
-        while len(all_messages) < limit:
-            result = self.get_messages(conversation_id, limit=min(100, limit - len(all_messages)), after=after)
+        while fetched < limit:
+            if first_page is not None:
+                result, first_page = first_page, None
+            else:
+                result = self.get_messages(conversation_id, limit=min(100, limit - fetched), after=after)
             
             if 'error' in result:
                 print(f"Error fetching messages: {result['error']}")
-                break
+                return
                 
             if 'data' not in result or not result['data']:
-                break
-                
-            all_messages.extend(result['data'])
+                return
+            
+            fetched += len(result['data'])
+            yield result['data']
             
             # Check if there are more pages
             paging = result.get('paging', {})
             next_url = paging.get('next')
             if not next_url:
-                break
+                return
                 
             # Extract cursor for next page
             after = paging.get('cursors', {}).get('after')
+            if not after:
+                return
+    
+    def get_new_messages(self, conversation_id: str, since: Optional[str], limit: int = 1000,
+                         first_page: Optional[Dict[str, Any]] = None) -> Tuple[List[Dict], bool]:
+        """Get messages created at or after `since`, newest first, stopping at the first page that reaches known history"""
+        new_messages = []
+        after = None
+        
+        while len(new_messages) < limit:
+            if first_page is not None:
+                result, first_page = first_page, None
+            else:
+                result = self.get_messages(conversation_id, limit=min(100, limit - len(new_messages)), after=after)
+            
+            if 'error' in result:
+                print(f"Error fetching messages: {result['error']}")
+                return new_messages, False
+            
+            page = result.get('data') or []
+            # Timestamps have one-second resolution, so the watermark's own second is fetched again;
+            # the index drops the repeats by message id
+            fresh = [m for m in page if not since or (m.get('created_time') or '') >= since]
+            new_messages.extend(fresh)
+            
+            # Messages come newest first, so an already indexed one means the rest are known too
+            if len(fresh) < len(page):
+                break
+            
+            # Check if there are more pages
+            paging = result.get('paging', {})
+            if not paging.get('next'):
+                break
+            after = paging.get('cursors', {}).get('after')
             if not after:
                 break
-                
-            # Be nice to the API
-            time.sleep(1)
         
-        return all_messages
+        return new_messages, True
     
-    def get_all_attachments_for_conversation(self, conversation_id: str, limit_messages: int = 1000) -> List[Dict]:
-        """Get all attachments from a specific conversation"""
-        messages = self.get_all_messages(conversation_id, limit_messages)
+    def sync_index(self, limit_conversations: int = 10, limit_messages: int = 1000):
+        """Bring the local index up to date, fetching only changed conversations and only their new messages"""
+        conversations = self.get_all_conversations(limit_conversations)
         
-        if not messages:
-            print(f"No messages found for conversation {conversation_id}")
-            return []
+        # A conversation whose updated_time matches its watermark has no new messages
+        stale = []
+        for conversation in conversations:
+            state = self.index.conversation_state(conversation.get('id'))
+            if state is None or state['updated_time'] != conversation.get('updated_time'):
+                stale.append((conversation, state))
+        
+        print(f"Syncing {len(stale)} of {len(conversations)} conversations")
+        if not stale:
+            return
+        
+        first_pages = [None] * len(stale)
+        if GRAPH_BATCH_READS:
+            pages = self.get_first_message_pages([c.get('id') for c, _ in stale], min(100, limit_messages))
+            first_pages = [page if 'error' not in page else None for page in pages]
         
+        def fetch(conversation, state, first_page):
+            since = state['newest_message_time'] if state else None
+            return self.get_new_messages(conversation.get('id'), since, limit_messages, first_page)
+        
+        jobs = [(conversation, state, first_page) for (conversation, state), first_page in zip(stale, first_pages)]
+        for (conversation, _, _), (messages, complete) in self.crawl(fetch, jobs):
+            conversation_id = conversation.get('id')
+            
+            # Advancing the watermarks after a partial fetch would skip the missing messages for good
+            if not complete:
+                continue
+            
+            attachments = []
+            for message in messages:
+                attachments.extend(self.message_attachments(message, conversation_id))
+            self.index.add_messages(conversation_id, conversation.get('updated_time'), messages, attachments)
+    
+    def message_attachments(self, message: Dict[str, Any], conversation_id: str = '') -> List[Dict]:
+        """Downloadable attachments of one message"""
         attachments = []
+        message_attachments = message.get('attachments', {}).get('data', [])
         
-        for message in messages:
-            message_attachments = message.get('attachments', {}).get('data', [])
-            
-            for attachment in message_attachments:
-                # Only process attachments with file_url (avoid stickers, etc.)
-                if attachment.get('file_url'):
-                    attachment_data = {
-                        'message_id': message.get('id'),
-                        'created_time': message.get('created_time'),
-                        'from': message.get('from', {}).get('name', 'Unknown'),
-                        'message_text': message.get('message', ''),
-                        'type': attachment.get('type'),
-                        'file_url': attachment.get('file_url'),
-                        'name': attachment.get('name', 'attachment'),
-                        'mime_type': attachment.get('mime_type', ''),
-                        'size': attachment.get('size', 0),
-                        'conversation_id': conversation_id
-                    }
-                    attachments.append(attachment_data)
+        for attachment in message_attachments:
+            # Only process attachments with file_url (avoid stickers, etc.)
+            if attachment.get('file_url'):
+                attachment_data = {
+                    'message_id': message.get('id'),
+                    'created_time': message.get('created_time'),
+                    'from': message.get('from', {}).get('name', 'Unknown'),
+                    'message_text': message.get('message', ''),
+                    'type': attachment.get('type'),
+                    'file_url': attachment.get('file_url'),
+                    'name': attachment.get('name', 'attachment'),
+                    'mime_type': attachment.get('mime_type', ''),
+                    'size': attachment.get('size', 0),
+                    'conversation_id': conversation_id
+                }
+                attachments.append(attachment_data)
         
         return attachments
     
-    def get_all_attachments(self, limit_conversations: int = 10, limit_messages: int = 1000) -> List[Dict]:
-        """Get all attachments from all conversations"""
-        conversations = self.get_all_conversations(limit_conversations)
+    def get_messages_by_id(self, message_ids: List[str]) -> List[Dict[str, Any]]:
+        """Fetch specific messages with their attachments, one targeted read per id"""
+        print(f"Fetching {len(message_ids)} messages by id...")
+        fields = self.message_params(1)['fields']
+        if GRAPH_BATCH_READS:
+            query = urlencode({'fields': fields})
+            calls = [{'method': 'GET', 'relative_url': f"{message_id}?{query}"} for message_id in message_ids]
+            return self.batch_request(calls)
         
-        if not conversations:
-            print("No conversations found")
-            return []
+        return [
+            self.make_api_request(f"{self.base_url}/{message_id}", {'fields': fields})
+            for message_id in message_ids
+        ]
+    
+    def refresh_attachment(self, attachment: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Refetch an attachment's message to get a current file_url, updating the index"""
+        message = self.get_messages_by_id([attachment['message_id']])[0]
+        if 'error' in message:
+            return None
         
-        all_attachments = []
+        for fresh in self.message_attachments(message, attachment.get('conversation_id', '')):
+            if fresh['name'] == attachment.get('name') and fresh['file_url'] != attachment.get('file_url'):
+                if self.index is not None:
+                    self.index.update_attachment(fresh)
+                return fresh
+        return None
+    
+    def download_files_by_message_ids(self, message_ids: List[str], download_path: str,
+                                      on_downloaded: Optional[Callable[[str], None]] = None,
+                                      manifest: Optional[Dict[str, Any]] = None,
+                                      parity_message_ids: Optional[List[str]] = None) -> List[str]:
+        """Download the attachments of the given messages without scanning any conversation"""
+        all_message_ids = list(message_ids) + list(parity_message_ids or [])
+        attachments = []
+        for message_id, message in zip(all_message_ids, self.get_messages_by_id(all_message_ids)):
+            if 'error' in message:
+                print(f"Error fetching message {message_id}: {message['error']}")
+                continue
+            attachments.extend(self.message_attachments(message))
         
-        for i, conversation in enumerate(conversations):
-            print(f"Processing conversation {i+1}/{len(conversations)}")
-            conversation_id = conversation.get('id')
-            
-            # Get conversation details for display
-            participants = conversation.get('participants', {}).get('data', [])
-            participant_names = [p.get('name', 'Unknown') for p in participants]
-            conversation_name = ', '.join(participant_names)
-            
-            print(f"Fetching attachments from: {conversation_name}")
-            
-            attachments = self.get_all_attachments_for_conversation(conversation_id, limit_messages)
-            all_attachments.extend(attachments)
-            
-            print(f"Found {len(attachments)} attachments in this conversation")
-            
-            # Be nice to the API
-            time.sleep(1)
+        segments = [a for a in attachments if not is_parity_name(a.get('name', ''))]
+        # Parity attachments are only downloaded if a segment has to be rebuilt
+        parity = [a for a in attachments if is_parity_name(a.get('name', ''))]
+        if not segments:
+            print("No attachments found in the given messages")
+            return []
         
-        return all_attachments
+        return self.download_attachments(segments, download_path, on_downloaded, manifest, parity)
     
-    def search_attachments_by_name(self, search_pattern: str, limit_conversations: int = 10, limit_messages: int = 1000) -> List[Dict]:
+    def crawl(self, func, jobs: List[Tuple]):
+        """Run func(*job) for each job on up to CONVERSATION_CRAWL_WORKERS threads, yielding (job, result) as each finishes"""
+        if not jobs:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=CONVERSATION_CRAWL_WORKERS) as executor:
+            futures = {executor.submit(func, *job): job for job in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+    
+    def search_attachments_by_name(self, search_pattern: str, limit_conversations: int = 10, limit_messages: int = 1000,
+                                   expected_parts: Optional[int] = None) -> List[Dict]:
         """Search for attachments that match a name pattern"""
-        all_attachments = self.get_all_attachments(limit_conversations, limit_messages)
+        if self.index is not None:
+            matching_attachments = self.index.find_by_name(search_pattern)
+            # The index may already hold every part; only sync when something is missing
+            if not expected_parts or count_segments(matching_attachments) < expected_parts:
+                self.sync_index(limit_conversations, limit_messages)
+                matching_attachments = self.index.find_by_name(search_pattern)
+            print(f"Found {len(matching_attachments)} matching attachments")
+            return matching_attachments
+        
+        matching_attachments = self.scan_for_attachments(
+            search_pattern, limit_conversations, limit_messages, expected_parts
+        )
+        print(f"Found {len(matching_attachments)} matching attachments")
+        return matching_attachments
+    
+    def scan_for_attachments(self, search_pattern: str, limit_conversations: int = 10, limit_messages: int = 1000,
+                             expected_parts: Optional[int] = None) -> List[Dict]:
+        """Page conversations newest first, filtering each page as it arrives"""
+        conversations = self.get_all_conversations(limit_conversations)
         
-        if not all_attachments:
+        if not conversations:
+            print("No conversations found")
             return []
         
+        # Fresh batches live in the most recently updated conversations
+        conversations.sort(key=lambda conversation: conversation.get('updated_time') or '', reverse=True)
+        
         # Create a regex pattern to match the search term
         pattern = re.compile(re.escape(search_pattern), re.IGNORECASE)
+        found = {}
+        found_lock = threading.Lock()
+        complete = threading.Event()
         
-        # Filter attachments that match the pattern
-        matching_attachments = [
-            attachment for attachment in all_attachments
-            if pattern.search(attachment.get('name', ''))
-        ]
+        def collect(messages, conversation_id):
+            with found_lock:
+                for message in messages:
+                    for attachment in self.message_attachments(message, conversation_id):
+                        name = attachment.get('name', '')
+                        if not pattern.search(name):
+                            continue
+                        known = found.get(name)
+                        if known is None or (attachment.get('created_time') or '') > (known.get('created_time') or ''):
+                            found[name] = attachment
+                # No further page is requested once every expected part was found
+                if expected_parts and count_segments(found.values()) >= expected_parts:
+                    complete.set()
         
-        print(f"Found {len(matching_attachments)} matching attachments")
-        return matching_attachments
+        # One batch request returns the first page of every conversation
+        first_pages = [None] * len(conversations)
+        if GRAPH_BATCH_READS:
+            conversation_ids = [conversation.get('id') for conversation in conversations]
+            pages = self.get_first_message_pages(conversation_ids, min(100, limit_messages))
+            # A conversation whose batched call failed is fetched on its own below
+            first_pages = [page if 'error' not in page else None for page in pages]
+            for conversation_id, page in zip(conversation_ids, first_pages):
+                if page is not None:
+                    collect(page.get('data') or [], conversation_id)
+        
+        def fetch(conversation, first_page):
+            if complete.is_set():
+                return
+            conversation_id = conversation.get('id')
+            for page in self.iter_message_pages(conversation_id, limit_messages, first_page):
+                collect(page, conversation_id)
+                if complete.is_set():
+                    return
+        
+        if not complete.is_set():
+            for _ in self.crawl(fetch, list(zip(conversations, first_pages))):
+                pass
+        
+        return sorted(found.values(), key=lambda attachment: attachment.get('created_time') or '', reverse=True)
     
-    def download_file(self, file_url: str, file_name: str, download_path: str) -> Optional[str]:
-        """Download a file from Facebook URL"""
+    def download_file(self, file_url: str, file_name: str, download_path: str,
+                      progress: Optional[DownloadProgress] = None) -> Optional[str]:
+        """Download a file from Facebook URL, reporting bytes to progress if given"""
         os.makedirs(download_path, exist_ok=True)
         
         # Ensure filename is safe
         safe_name = "".join(c for c in file_name if c.isalnum() or c in "._- ")
         file_path = os.path.join(download_path, safe_name)
+        # Data goes to '<name>.part', which a later call for the same file can continue with a Range request
+        part_path = file_path + '.part'
         
-        # Add unique identifier if file already exists
-        counter = 1
-        while os.path.exists(file_path):
-            name, ext = os.path.splitext(safe_name)
-            file_path = os.path.join(download_path, f"{name}_{counter}{ext}")
-            counter += 1
-        
-        try:
+        # Concurrent downloads report through the shared progress instead
+        if progress is None:
             print(f"Downloading: {safe_name}")
+        
+        # Add access token to the file URL for authentication
+        parsed_url = urlparse(file_url)
+        query_params = parse_qs(parsed_url.query)
+        query_params['access_token'] = [self.access_token]
+        
+        # Rebuild URL with access token
+        new_query = urlencode(query_params, doseq=True)
+        download_url = urlunparse((
+            parsed_url.scheme,
+            parsed_url.netloc,
+            parsed_url.path,
+            parsed_url.params,
+            new_query,
+            parsed_url.fragment
+        ))
+        
+        attempt = 0
+        reported = 0
+        while True:
+            try:
+                state = self._load_part_state(part_path)
+                offset = os.path.getsize(part_path) if state is not None else 0
+                if progress is not None:
+                    progress.add(offset - reported)
+                reported = offset
+                
+                if state is not None and state['size'] and offset >= state['size']:
+                    break
+                
+                headers = {}
+                if offset:
+                    headers['Range'] = f"bytes={offset}-"
+                    if state['validator']:
+                        headers['If-Range'] = state['validator']
+                
+                response = self.session.get(download_url, headers=headers, stream=True, timeout=60)
+                with response:
+                    if response.status_code == 416:
+                        # The partial file no longer fits the remote file
+                        self._remove_part(part_path)
+                        raise DownloadError("Requested range not satisfiable")
+                    if response.status_code in (500, 502, 503, 504):
+                        raise DownloadError(f"HTTP {response.status_code}")
+                    if response.status_code not in (200, 206):
+                        print(f"Download failed: HTTP {response.status_code}")
+                        print(f"Response: {response.text}")
+                        return None
+                    
+                    if response.status_code == 206:
+                        mode = 'ab'
+                    else:
+                        # No range support, or the file changed: start over with this response
+                        mode = 'wb'
+                        if progress is not None:
+                            progress.add(-reported)
+                        reported = offset = 0
+                        state = {
+                            'validator': response.headers.get('ETag') or response.headers.get('Last-Modified', ''),
+                            'size': int(response.headers.get('content-length', 0)),
+                        }
+                        self._save_part_state(part_path, state)
+                    
+                    with open(part_path, mode) as file:
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            if chunk:
+                                file.write(chunk)
+                                offset += len(chunk)
+                                if progress is not None:
+                                    progress.add(len(chunk))
+                                    reported = offset
+                                # Show progress for large files
+                                elif state['size'] > 0 and offset % (1024 * 1024) == 0:
+                                    percent = (offset / state['size']) * 100
+                                    print(f"Download progress: {percent:.1f}% ({offset}/{state['size']} bytes)")
+                    
+                    if state['size'] and offset < state['size']:
+                        raise DownloadError("Connection closed before the file was complete")
+                break
             
-            # Add access token to the file URL for authentication
-            parsed_url = urlparse(file_url)
-            query_params = parse_qs(parsed_url.query)
-            query_params['access_token'] = [self.access_token]
-            
-            # Rebuild URL with access token
-            new_query = urlencode(query_params, doseq=True)
-            download_url = urlunparse((
-                parsed_url.scheme,
-                parsed_url.netloc,
-                parsed_url.path,
-                parsed_url.params,
-                new_query,
-                parsed_url.fragment
-            ))
-            
-            # Download the file with streaming
-            response = requests.get(download_url, stream=True, timeout=60)
-            
-            if response.status_code != 200:
-                print(f"Download failed: HTTP {response.status_code}")
-                print(f"Response: {response.text}")
+            except (requests.exceptions.RequestException, DownloadError) as e:
+                attempt += 1
+                if attempt > SEGMENT_DOWNLOAD_RETRIES:
+                    print(f"Error downloading {safe_name}: {e}")
+                    return None
+                # Retry from the last byte written rather than from the start of the file
+                time.sleep(min(2 ** attempt, 30))
+            except Exception as e:
+                print(f"Error downloading {safe_name}: {e}")
                 return None
-            
-            # Get file size for progress tracking
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded_size = 0
-            
-            with open(file_path, 'wb') as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        file.write(chunk)
-                        downloaded_size += len(chunk)
-                        
-                        # Show progress for large files
-                        if total_size > 0 and downloaded_size % (1024 * 1024) == 0:
-                            progress = (downloaded_size / total_size) * 100
-                            print(f"Download progress: {progress:.1f}% ({downloaded_size}/{total_size} bytes)")
-            
+        
+        os.replace(part_path, file_path)
+        self._remove_part_state(part_path)
+        if progress is None:
             file_size = os.path.getsize(file_path)
             print(f"Successfully downloaded: {safe_name} ({file_size} bytes)")
-            return file_path
-            
-        except Exception as e:
-            print(f"Error downloading {safe_name}: {e}")
+        return file_path
+    
+    def _load_part_state(self, part_path: str) -> Optional[Dict[str, Any]]:
+        """Validator and size recorded for a partial download, or None if there is nothing to resume"""
+        try:
+            with open(part_path + '.state') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
             return None
+        if not os.path.exists(part_path) or not state.get('validator'):
+            return None
+        return state
+    
+    def _save_part_state(self, part_path: str, state: Dict[str, Any]):
+        temp_path = part_path + '.state.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, part_path + '.state')
+    
+    def _remove_part_state(self, part_path: str):
+        try:
+            os.remove(part_path + '.state')
+        except OSError:
+            pass
+    
+    def _remove_part(self, part_path: str):
+        for path in (part_path, part_path + '.state'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
     
     def download_files_by_name_pattern(self, search_pattern: str, download_path: str, 
-                                     limit_conversations: int = 10, limit_messages: int = 1000) -> List[str]:
-        """Download all files matching a name pattern"""
+                                     limit_conversations: int = 10, limit_messages: int = 1000,
+                                     expected_parts: Optional[int] = None,
+                                     on_downloaded: Optional[Callable[[str], None]] = None,
+                                     manifest: Optional[Dict[str, Any]] = None,
+                                     existing: Optional[Dict[str, str]] = None) -> List[str]:
+        """Download all files matching a name pattern, verifying them against the batch manifest if one is found"""
         # Search for attachments matching the pattern
         matching_attachments = self.search_attachments_by_name(
-            search_pattern, limit_conversations, limit_messages
+            search_pattern, limit_conversations, limit_messages, expected_parts
         )
         
         if not matching_attachments:
             print("No matching files found")
             return []
         
-        print(f"Downloading {len(matching_attachments)} matching files...")
+        manifests = [a for a in matching_attachments if is_manifest_name(a.get('name', ''))]
+        parity = [a for a in matching_attachments if is_parity_name(a.get('name', ''))]
+        segments = [
+            a for a in matching_attachments
+            if not is_manifest_name(a.get('name', '')) and not is_parity_name(a.get('name', ''))
+        ]
+        if manifest is None and manifests:
+            manifest = self.download_manifest(manifests[0], download_path)
         
-        # Download the files
-        downloaded_files = []
-        for attachment in matching_attachments:
-            try:
-                file_url = attachment.get('file_url')
-                file_name = attachment.get('name', 'attachment')
-                
-                print(f"Downloading: {file_name}")
-                
-                # Download the file
-                file_path = self.download_file(file_url, file_name, download_path)
-                
+        return self.download_attachments(segments, download_path, on_downloaded, manifest, parity, existing)
+    
+    def download_manifest(self, attachment: Dict, download_path: str) -> Optional[Dict[str, Any]]:
+        """Download and parse a batch manifest part, or return None if it cannot be read"""
+        file_path = self.download_attachment(attachment, download_path)
+        if not file_path:
+            return None
+        try:
+            return read_manifest(file_path)
+        except ValueError as e:
+            print(f"Ignoring manifest {attachment.get('name')}: {e}")
+            return None
+        finally:
+            os.remove(file_path)
+    
+    def download_attachments(self, attachments: List[Dict], download_path: str,
+                             on_downloaded: Optional[Callable[[str], None]] = None,
+                             manifest: Optional[Dict[str, Any]] = None,
+                             parity_attachments: Optional[List[Dict]] = None,
+                             existing: Optional[Dict[str, str]] = None) -> List[str]:
+        """Download a list of attachments concurrently, returning the local paths of those that succeeded"""
+        existing = existing or {}
+        # The same segment appears more than once when a batch was sent again; one copy is enough
+        unique_attachments = {}
+        for attachment in attachments:
+            # Segments already on disk are neither downloaded nor rebuilt again
+            if attachment.get('name', 'attachment') in existing:
+                continue
+            unique_attachments.setdefault(attachment.get('name', 'attachment'), attachment)
+        attachments = list(unique_attachments.values())
+        
+        print(f"Downloading {len(attachments)} matching files...")
+        total_bytes = sum(int(attachment.get('size') or 0) for attachment in attachments)
+        progress = DownloadProgress(total_bytes, len(attachments))
+        entries = {part['name']: part for part in (manifest or {}).get('parts', [])}
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SEGMENT_DOWNLOAD_WORKERS) as executor:
+            futures = [
+                executor.submit(self.download_attachment, attachment, download_path, progress,
+                                entries.get(attachment.get('name')))
+                for attachment in attachments
+            ]
+            if on_downloaded is not None:
+                for future in concurrent.futures.as_completed(futures):
+                    if future.result():
+                        on_downloaded(future.result())
+            downloaded_files = [future.result() for future in futures]
+        
+        downloaded = dict(existing)
+        downloaded.update({
+            attachment.get('name'): file_path
+            for attachment, file_path in zip(attachments, downloaded_files) if file_path
+        })
+        if manifest and parity_attachments:
+            for file_path in self.rebuild_segments(manifest, downloaded, parity_attachments, download_path):
+                if on_downloaded is not None:
+                    on_downloaded(file_path)
+                downloaded_files.append(file_path)
+        
+        return [file_path for file_path in downloaded_files if file_path]
+    
+    def rebuild_segments(self, manifest: Dict[str, Any], downloaded: Dict[str, str],
+                         parity_attachments: List[Dict], download_path: str) -> List[str]:
+        """Rebuild the manifest segments missing from downloaded out of parity segments, without asking the server again"""
+        parts = manifest['parts']
+        missing = {i: part for i, part in enumerate(parts) if part['name'] not in downloaded}
+        if not missing:
+            return []
+        if not erasure.available():
+            print("NumPy is not installed, missing segments cannot be rebuilt from parity")
+            return []
+        
+        print(f"Rebuilding {len(missing)} missing segment(s) from parity...")
+        parity_entries = {part['name']: part for part in manifest.get('parity_parts', [])}
+        parity_files = {}
+        try:
+            # Only as many parity segments as there are missing segments are downloaded
+            for attachment in parity_attachments:
+                if len(parity_files) >= len(missing):
+                    break
+                file_path = self.download_attachment(attachment, download_path,
+                                                     expected=parity_entries.get(attachment.get('name')))
                 if file_path:
-                    downloaded_files.append(file_path)
-                    print(f"Successfully downloaded: {file_name}")
-                else:
-                    print(f"Failed to download: {file_name}")
-                    
-            except Exception as e:
-                print(f"Error downloading {file_name}: {e}")
+                    header = read_parity_header(file_path)
+                    parity_files[header.parity_index] = {
+                        'path': file_path,
+                        'offset': header.payload_offset,
+                        'shard_size': header.shard_size
+                    }
+            
+            if len(parity_files) < len(missing):
+                print(f"Only {len(parity_files)} parity segments available for {len(missing)} missing segments")
+                return []
+            
+            data_files = {i: downloaded[part['name']] for i, part in enumerate(parts) if part['name'] in downloaded}
+            output_files = {i: os.path.join(download_path, part['name']) for i, part in missing.items()}
+            shard_size = next(iter(parity_files.values()))['shard_size']
+            erasure.rebuild_shards(shard_size, data_files, parity_files, output_files)
+        except (OSError, ValueError) as e:
+            print(f"Could not rebuild missing segments: {e}")
+            return []
+        finally:
+            for parity_file in parity_files.values():
+                os.remove(parity_file['path'])
+        
+        rebuilt = []
+        for i, file_path in output_files.items():
+            # Shards are zero-padded to the longest segment
+            with open(file_path, 'r+b') as f:
+                f.truncate(missing[i]['size'])
+            if verify_segment(file_path, missing[i]):
+                print(f"Rebuilt segment: {missing[i]['name']}")
+                rebuilt.append(file_path)
+            else:
+                print(f"Rebuilt segment {missing[i]['name']} does not match the manifest")
+                os.remove(file_path)
+        return rebuilt
+    
+    def download_attachment(self, attachment: Dict, download_path: str,
+                            progress: Optional[DownloadProgress] = None,
+                            expected: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Download one attachment, refreshing its URL once if the download fails"""
+        file_name = attachment.get('name', 'attachment')
+        try:
+            file_url = attachment.get('file_url')
+            
+            # Download the file
+            file_path = self.download_verified(file_url, file_name, download_path, progress, expected)
+            
+            # Indexed file URLs expire; look the message up again for a fresh one
+            refreshed = None
+            if not file_path and attachment.get('message_id'):
+                refreshed = self.refresh_attachment(attachment)
+                if refreshed:
+                    file_path = self.download_verified(refreshed['file_url'], file_name, download_path, progress, expected)
+            
+            # A corrupt copy is fetched again from the same URL when there was no fresh one
+            if not file_path and refreshed is None and expected is not None:
+                file_path = self.download_verified(file_url, file_name, download_path, progress, expected)
+            
+            if not file_path:
+                print(f"Failed to download: {file_name}")
+            return file_path
+        
+        except Exception as e:
+            print(f"Error downloading {file_name}: {e}")
+            return None
+        finally:
+            if progress is not None:
+                progress.file_done()
+    
+    def download_verified(self, file_url: str, file_name: str, download_path: str,
+                          progress: Optional[DownloadProgress] = None,
+                          expected: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Download a file and check it against its manifest entry, deleting it if it does not match"""
+        with self.host_slot(file_url):
+            file_path = self.download_file(file_url, file_name, download_path, progress)
         
-        return downloaded_files
+        if file_path and expected is not None and not verify_segment(file_path, expected):
+            print(f"Segment {file_name} does not match the manifest, discarding it")
+            os.remove(file_path)
+            return None
+        return file_path
+    
+    def host_slot(self, url: str) -> threading.BoundedSemaphore:
+        """Semaphore limiting concurrent downloads from the host of url"""
+        host = urlparse(url or '').netloc
+        with self.host_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(SEGMENT_DOWNLOADS_PER_HOST)
+            return self.host_semaphores[host]
+
+def count_segments(attachments) -> int:
+    """Distinct segment names among attachments, not counting manifest and parity parts"""
+    return len({
+        a.get('name') for a in attachments
+        if not is_manifest_name(a.get('name', '')) and not is_parity_name(a.get('name', ''))
+    })
+
+# Keep-alive connection to the remote server for the start request and status polling
+server_session = create_session(pool_size=2)
 
 def init_facebook_service():
     """Initialize Facebook service for downloading files"""
-    return FacebookAttachmentDownloader(PAGE_ACCESS_TOKEN)
+    return FacebookAttachmentDownloader(PAGE_ACCESS_TOKEN, index_path=ATTACHMENT_INDEX_PATH)
 
-def request_download(file_url):
+def request_download(file_url, max_attempts=5):
     """Request remote server to download and process a file"""
     try:
-        response = requests.post(
-            f"{REMOTE_SERVER_URL}/start_download",
-            json={'file_url': file_url},
-            timeout=30
-        )
+        for attempt in range(max_attempts):
+            response = server_session.post(
+                f"{REMOTE_SERVER_URL}/start_download",
+                json={'file_url': file_url},
+                timeout=30
+            )
+            
+            # Server is at capacity; wait as long as it asks before retrying
+            if response.status_code == 429 and attempt < max_attempts - 1:
+                retry_after = int(response.headers.get('Retry-After', 5))
+                print(f"Server busy. Retrying in {retry_after} seconds...")
+                time.sleep(retry_after)
+                continue
+            break
         
         if response.status_code != 200:
             print(f"Server error: {response.status_code} - {response.text}")
@@ -430,7 +1045,7 @@ def request_download(file_url):
 def check_operation_status(batch_id):
     """Check the status of an operation on the remote server"""
     try:
-        response = requests.get(
+        response = server_session.get(
             f"{REMOTE_SERVER_URL}/operation_status/{batch_id}",
             timeout=10
         )
@@ -442,18 +1057,106 @@ def check_operation_status(batch_id):
     except:
         return None
 
-def download_files_by_name_pattern(batch_id, facebook_service):
-    """Download files by searching for the name pattern"""
-    print(f"Looking for files with pattern: enc_{batch_id}")
+def stream_operation_status(batch_id, last_version=0):
+    """Yield status updates pushed by the server's Server-Sent Events stream"""
+    headers = {'Accept': 'text/event-stream'}
+    if last_version:
+        headers['Last-Event-ID'] = str(last_version)
+    
+    # The read timeout only has to outlast the server's keep-alive interval
+    response = server_session.get(
+        f"{REMOTE_SERVER_URL}/operation_events/{batch_id}",
+        headers=headers,
+        stream=True,
+        timeout=(10, 60)
+    )
+    with response:
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError(f"HTTP {response.status_code}")
+        
+        event, data = 'message', []
+        for line in response.iter_lines(decode_unicode=True):
+            if line:
+                field, _, value = line.partition(':')
+                value = value[1:] if value.startswith(' ') else value
+                if field == 'event':
+                    event = value
+                elif field == 'data':
+                    data.append(value)
+                continue
+            
+            # A blank line ends the event
+            if event == 'status' and data:
+                yield json.loads('\n'.join(data))
+            elif event == 'gone':
+                return
+            event, data = 'message', []
+
+def watch_operation_status(batch_id, poll_interval=2):
+    """Yield the operation's status whenever it changes until it completes or fails"""
+    last_version = 0
+    failures = 0
+    while failures < 3:
+        try:
+            for status in stream_operation_status(batch_id, last_version):
+                failures = 0
+                last_version = status.get('version', last_version)
+                yield status
+                if status.get('status') in ('completed', 'error'):
+                    return
+            failures += 1
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Status stream interrupted: {e}")
+            failures += 1
+    
+    print("Status stream unavailable, polling instead")
+    while True:
+        status = check_operation_status(batch_id)
+        
+        if not status:
+            print("Failed to get operation status")
+            time.sleep(5)
+            continue
+        
+        if status.get('version') != last_version:
+            last_version = status.get('version')
+            yield status
+        if status.get('status') in ('completed', 'error'):
+            return
+        time.sleep(poll_interval)
+
+def download_files_by_name_pattern(segment_prefix, facebook_service, expected_parts=None, on_downloaded=None,
+                                   manifest=None, existing=None):
+    """Download files by searching for the name pattern, stopping once expected_parts were found"""
+    print(f"Looking for files with pattern: {segment_prefix}")
     
-    # Search for files matching the pattern "enc_{batch_id}"
-    search_pattern = f"enc_{batch_id}"
+    # Search for files matching the pattern "enc_{batch_id}"; a deduplicated
+    # operation points at the segments of the batch that first uploaded them
+    search_pattern = segment_prefix
     downloaded_files = facebook_service.download_files_by_name_pattern(
-        search_pattern, DOWNLOAD_FOLDER, limit_conversations=20, limit_messages=100
+        search_pattern, DOWNLOAD_FOLDER, limit_conversations=20, limit_messages=100,
+        expected_parts=expected_parts, on_downloaded=on_downloaded, manifest=manifest, existing=existing
     )
     
     return downloaded_files
 
+def download_and_decrypt(download, decryptor, output_file, expected_parts=None):
+    """Run download(on_downloaded) in the background and decrypt each segment as soon as it lands"""
+    stream = SegmentStream(expected_parts)
+    result = {'files': []}
+    
+    def run():
+        try:
+            result['files'] = download(stream.add)
+        finally:
+            stream.close()
+    
+    downloader = threading.Thread(target=run, daemon=True)
+    downloader.start()
+    success = decryptor.decrypt_segments(stream, output_file, FIXED_PASSWORD)
+    downloader.join()
+    return result['files'], success
+
 def main():
     """Main function"""
     print("Facebook File Transfer Client")
@@ -463,7 +1166,7 @@ def main():
     facebook_service = init_facebook_service()
     
     # Initialize decryptor
-    decryptor = FileDecryptor()
+    decryptor = FileDecryptor(workers=ENCRYPTION_WORKERS)
     
     while True:
         print("\nOptions:")
@@ -496,45 +1199,52 @@ def main():
             print(f"Download started with Batch ID: {batch_id}")
             print("Waiting for remote server to process and upload files...")
             
-            # Wait for the operation to complete
-            operation_start_time = time.time()
-            while True:
-                status = check_operation_status(batch_id)
-                
-                if not status:
-                    print("Failed to get operation status")
-                    time.sleep(5)
-                    continue
-                
+            # Wait for the operation to complete; the server pushes each change
+            status = {}
+            last_reported = None
+            for status in watch_operation_status(batch_id):
                 if status.get('status') == 'completed':
                     print("Remote processing completed. Downloading files from Facebook...")
-                    break
                 elif status.get('status') == 'error':
                     print(f"Remote processing failed: {status.get('error', 'Unknown error')}")
-                    break
                 else:
-                    # Only show progress every 10 seconds to avoid spam
-                    if time.time() - operation_start_time > 10:
-                        print(f"Status: {status.get('current_stage')} - Progress: {status.get('progress', 0)}%")
-                        operation_start_time = time.time()
-                    time.sleep(2)
+                    # Only report stage and progress changes, not every attachment added
+                    report = (status.get('current_stage'), status.get('progress', 0))
+                    if report != last_reported:
+                        print(f"Status: {report[0]} - Progress: {report[1]}%")
+                        last_reported = report
             
-            # Download files using name pattern search
-            downloaded_files = download_files_by_name_pattern(batch_id, facebook_service)
+            # Fetch the sent segments directly by message id, scanning conversations only as a fallback.
+            # Each segment is decrypted as soon as its download completes.
+            segment_prefix = status.get('segment_prefix') or f"enc_{batch_id}"
+            output_file = os.path.join(DOWNLOAD_FOLDER, original_filename)
+            message_ids = status.get('message_ids', [])
+            # Segments are verified against the manifest as they arrive, so only corrupt ones are fetched again
+            manifest = status.get('manifest')
+            # Knowing how many segments exist lets the search stop once all were found
+            expected_parts = status.get('part_count') or len(message_ids) or None
+            
+            def download(on_downloaded):
+                files = []
+                if message_ids:
+                    files = facebook_service.download_files_by_message_ids(
+                        message_ids, DOWNLOAD_FOLDER, on_downloaded, manifest, status.get('parity_message_ids')
+                    )
+                    if len(files) >= len(message_ids):
+                        return files
+                    print("Some segments could not be fetched by id, searching conversations for the missing ones")
+                # Verified segments stay on disk and in the stream; the search only fetches the rest
+                existing = {os.path.basename(file_path): file_path for file_path in files}
+                return files + download_files_by_name_pattern(
+                    segment_prefix, facebook_service, expected_parts, on_downloaded, manifest, existing
+                )
+            
+            downloaded_files, success = download_and_decrypt(download, decryptor, output_file, expected_parts)
             
             if not downloaded_files:
                 print("No files found. The operation may have failed or files may not be visible yet.")
                 continue
             
-            # Decrypt the files
-            print("Decrypting files...")
-            output_file = os.path.join(DOWNLOAD_FOLDER, original_filename)
-            
-            # Create pattern for decryptor (encrypted files start with "enc_")
-            pattern = os.path.join(DOWNLOAD_FOLDER, f"enc_{batch_id}_part*.pdf")
-            
-            success = decryptor.decrypt_file(pattern, output_file, FIXED_PASSWORD)
-            
             if success:
                 print(f"File successfully decrypted to: {output_file}")
                 
@@ -0,0 +1,85 @@
+import bz2
+import collections
+import lzma
+import math
+import mimetypes
+import zlib
+from typing import Optional, Tuple
+
+# Codec identifiers recorded in each frame header
+CODEC_STORED = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_BZ2 = 3
+
+# Speed/ratio policies mapped to the codec and level they use
+COMPRESSION_POLICIES = {
+    'fast': (CODEC_ZLIB, 1),
+    'balanced': (CODEC_ZLIB, 6),
+    'compact': (CODEC_BZ2, 9),
+    'max': (CODEC_LZMA, 6),
+}
+
+# Blocks whose sample has more bits of entropy per byte than this are stored as-is
+ENTROPY_SAMPLE_SIZE = 64 * 1024
+ENTROPY_THRESHOLD = 7.5
+
+# Compressed output must save at least this fraction to be kept
+MIN_SAVINGS = 0.02
+
+# MIME types whose payloads are already compressed
+INCOMPRESSIBLE_MIME_PREFIXES = ('video/', 'audio/')
+INCOMPRESSIBLE_MIME_TYPES = {
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/heic', 'image/avif',
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+    'application/x-xz', 'application/x-7z-compressed', 'application/x-rar-compressed',
+    'application/vnd.rar', 'application/zstd', 'application/java-archive',
+    'application/vnd.android.package-archive',
+}
+
+def is_incompressible_type(file_name: str, mime_type: Optional[str] = None) -> bool:
+    """Check whether a file is already compressed, judging by its MIME type or name"""
+    if not mime_type:
+        mime_type, _ = mimetypes.guess_type(file_name)
+    if not mime_type:
+        return False
+    mime_type = mime_type.split(';')[0].strip().lower()
+    return mime_type.startswith(INCOMPRESSIBLE_MIME_PREFIXES) or mime_type in INCOMPRESSIBLE_MIME_TYPES
+
+def sample_entropy(data: bytes) -> float:
+    """Shannon entropy in bits per byte of the first ENTROPY_SAMPLE_SIZE bytes"""
+    sample = data[:ENTROPY_SAMPLE_SIZE]
+    if not sample:
+        return 0.0
+    total = len(sample)
+    counts = collections.Counter(sample)
+    return -sum(count / total * math.log2(count / total) for count in counts.values())
+
+def compress_block(data: bytes, policy: str = 'balanced', skip: bool = False) -> Tuple[int, bytes]:
+    """Compress a block with the policy's codec, falling back to storing it when that does not pay off"""
+    if skip or sample_entropy(data) > ENTROPY_THRESHOLD:
+        return CODEC_STORED, data
+
+    codec, level = COMPRESSION_POLICIES[policy]
+    if codec == CODEC_ZLIB:
+        compressed = zlib.compress(data, level)
+    elif codec == CODEC_LZMA:
+        compressed = lzma.compress(data, preset=level)
+    else:
+        compressed = bz2.compress(data, compresslevel=level)
+
+    if len(compressed) > len(data) * (1 - MIN_SAVINGS):
+        return CODEC_STORED, data
+    return codec, compressed
+
+def decompress_block(codec: int, data: bytes) -> bytes:
+    """Decompress a block using the codec recorded in its frame header"""
+    if codec == CODEC_STORED:
+        return data
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_LZMA:
+        return lzma.decompress(data)
+    if codec == CODEC_BZ2:
+        return bz2.decompress(data)
+    raise ValueError(f"Unknown compression codec: {codec}")
@@ -1,7 +1,59 @@
-PAGE_ACCESS_TOKEN = "you_page_accesstoken"
-FIXED_PASSWORD = "your_fixed_password_here"
-REMOTE_SERVER_URL = "server_address"
-UPLOAD_FOLDER = 'uploads'
-RECIPIENT_ID = "your_receipient_id"
-DOWNLOAD_FOLDER = 'downloads'
-
+PAGE_ACCESS_TOKEN = "you_page_accesstoken"
+FIXED_PASSWORD = "your_fixed_password_here"
+REMOTE_SERVER_URL = "server_address"
+UPLOAD_FOLDER = 'uploads'
+RECIPIENT_ID = "your_receipient_id"
+DOWNLOAD_FOLDER = 'downloads'
+
+ENCRYPTION_BUFFER_SIZE = 1024 * 1024  # Bytes read, compressed and sealed per block; bounds memory per encryption worker
+ENCRYPTION_WORKERS = 0  # Processes used to compress/encrypt segments; 0 uses every CPU core
+COMPRESSION_POLICY = 'balanced'  # 'fast', 'balanced', 'compact' (bz2) or 'max' (lzma)
+DOWNLOAD_CONNECTIONS = 4  # Parallel HTTP Range requests per source download
+SOURCE_RESUME_TTL = 24 * 3600  # Seconds a partial source download is kept for a retry to resume
+PARITY_SEGMENTS = 0  # Reed-Solomon parity segments per batch (needs NumPy); any N of the N + K parts rebuild the file
+
+# Job scheduling for /start_download
+MAX_CONCURRENT_JOBS = 4  # Operations processed at the same time
+MAX_QUEUED_JOBS = 32  # Further requests get 429 with Retry-After
+MAX_QUEUED_BYTES = 20 * 1024 * 1024 * 1024  # Estimated source bytes allowed in the queue; 0 disables the limit
+STAGE_CONCURRENCY = {  # Concurrent work per pipeline stage across all operations
+    'downloading': 4,
+    'uploading': 3,
+    'sending': 2,
+}
+
+# Operation tracking: 'memory' (per process) or 'sqlite' (shared between workers, survives restarts)
+OPERATION_STORE = 'memory'
+OPERATION_STORE_PATH = 'operations.db'
+OPERATION_TTL = 24 * 3600  # Seconds a finished operation stays queryable
+OPERATION_MAX_ENTRIES = 10000  # Memory backend only
+
+# Reuse of uploaded segments for repeated sources (matched by URL + ETag/Last-Modified or by content hash)
+DEDUP_CACHE_TTL = 7 * 24 * 3600  # Seconds a set of attachment_ids is reused
+DEDUP_CACHE_MAX_ENTRIES = 1000
+
+# Graph API requests per second for each endpoint class, shared by all operations in a process.
+# The limiter slows down on 429s and as X-App-Usage / X-Page-Usage approach 100%.
+GRAPH_API_RATE_LIMITS = {
+    'upload': 3,
+    'send': 10,
+    'read': 20,
+}
+
+# Graph API root; point it at a local mock server for testing
+GRAPH_API_URL = "https://graph.facebook.com/v19.0"
+GRAPH_BATCH_SIZE = 50  # Calls per Graph batch request (the API allows at most 50)
+GRAPH_BATCH_SENDS = True  # Send segment messages through batch requests instead of two POSTs per part
+GRAPH_BATCH_READS = True  # Fetch the first message page of every conversation in one batch request
+
+# Seconds between keep-alive comments on /operation_events streams
+STATUS_STREAM_HEARTBEAT = 15
+
+# Client-side SQLite index of conversations and attachments, synced incrementally; '' disables it
+ATTACHMENT_INDEX_PATH = 'attachments.db'
+
+# Concurrent segment downloads on the client
+SEGMENT_DOWNLOAD_WORKERS = 8
+SEGMENT_DOWNLOADS_PER_HOST = 4
+SEGMENT_DOWNLOAD_RETRIES = 5  # Resumed attempts per segment after a broken transfer
+CONVERSATION_CRAWL_WORKERS = 4  # Conversations paged concurrently; the read rate in GRAPH_API_RATE_LIMITS is the budget
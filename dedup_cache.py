@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+class DedupCache:
+    """Content-addressed cache of uploaded segments.
+
+    Maps a source URL plus its validator (ETag or Last-Modified) and the
+    SHA-256 of the source bytes to the reusable attachment_ids of the
+    segments that were uploaded for it, so a repeat request can skip
+    straight to sending. Entries expire after ttl seconds and the least
+    recently used ones are evicted beyond max_entries.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def url_key(file_url: str, validator: str) -> Optional[str]:
+        # Without a validator the URL alone says nothing about the content
+        if not validator:
+            return None
+        return f"url:{file_url}|{validator}"
+
+    @staticmethod
+    def content_key(content_hash: str) -> str:
+        return f"sha256:{content_hash}"
+
+    def lookup_url(self, file_url: str, validator: str) -> Optional[Dict[str, Any]]:
+        key = self.url_key(file_url, validator)
+        return self._get(key) if key else None
+
+    def lookup_content(self, content_hash: str) -> Optional[Dict[str, Any]]:
+        return self._get(self.content_key(content_hash))
+
+    def store(self, file_url: str, validator: str, content_hash: str, attachment_ids: List[str],
+              segment_prefix: str, original_filename: str, manifest: Optional[Dict[str, Any]] = None):
+        """Remember the segments of a fully sent batch under its URL and content keys"""
+        entry = {
+            'attachment_ids': list(attachment_ids),
+            'segment_prefix': segment_prefix,
+            'original_filename': original_filename,
+            'manifest': manifest,
+            'content_hash': content_hash,
+            'stored_time': time.time(),
+        }
+        keys = [self.content_key(content_hash), self.url_key(file_url, validator)]
+        with self._lock:
+            for key in keys:
+                if key:
+                    self._entries[key] = entry
+                    self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, content_hash: str):
+        """Drop every key pointing at the given content, e.g. after a reused attachment failed to send"""
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e['content_hash'] == content_hash]:
+                del self._entries[key]
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry['stored_time'] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return dict(entry, attachment_ids=list(entry['attachment_ids']))
@@ -0,0 +1,175 @@
+import os
+from typing import Dict, List
+
+# NumPy is only needed when parity segments are enabled
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# GF(2^8) with the primitive polynomial x^8 + x^4 + x^3 + x^2 + 1
+GF_POLYNOMIAL = 0x11d
+
+# Data shards take field elements 0, 1, 2, ... and parity shards 255, 254, ...,
+# so a shard's coefficients do not depend on how many shards the batch has
+MAX_SHARDS = 256
+
+# Bytes of every shard processed per step
+COLUMN_BLOCK_SIZE = 1024 * 1024
+
+def available() -> bool:
+    """Whether parity segments can be computed and used here"""
+    return np is not None
+
+def _build_tables():
+    exp = [0] * 512
+    log = [0] * 256
+    value = 1
+    for power in range(255):
+        exp[power] = value
+        log[value] = power
+        value <<= 1
+        if value & 0x100:
+            value ^= GF_POLYNOMIAL
+    for power in range(255, 512):
+        exp[power] = exp[power - 255]
+    return exp, log
+
+GF_EXP, GF_LOG = _build_tables()
+
+def gf_mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+def gf_inv(a: int) -> int:
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return GF_EXP[255 - GF_LOG[a]]
+
+def parity_coefficient(parity_index: int, data_index: int) -> int:
+    """Cauchy matrix entry 1 / (x_j + y_i); every square submatrix of a Cauchy matrix is invertible"""
+    return gf_inv((MAX_SHARDS - 1 - parity_index) ^ data_index)
+
+_mul_table = None
+
+def _multiplication_table():
+    """256x256 table with row c holding c * x for every byte x, so a row lookup multiplies a whole block"""
+    global _mul_table
+    if np is None:
+        raise RuntimeError("Parity segments require NumPy (pip install numpy)")
+    if _mul_table is None:
+        table = np.zeros((256, 256), dtype=np.uint8)
+        for a in range(1, 256):
+            for b in range(1, 256):
+                table[a, b] = GF_EXP[GF_LOG[a] + GF_LOG[b]]
+        _mul_table = table
+    return _mul_table
+
+def _read_block(f, length: int):
+    """Read up to length bytes as a uint8 array, zero-padded to length past the end of the shard"""
+    block = np.zeros(length, dtype=np.uint8)
+    data = f.read(length)
+    block[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+    return block
+
+class ParityEncoder:
+    """Accumulate K Reed-Solomon parity shards over data shards added one at a time.
+
+    Each data shard (a whole segment file, zero-padded to the longest one)
+    is folded into every parity shard as soon as it is complete, reading it
+    in column blocks, so data shards never have to be held together.
+    Memory is parity_count times the longest shard.
+    """
+
+    def __init__(self, parity_count: int):
+        self.table = _multiplication_table()
+        self.parity_count = parity_count
+        self.data_count = 0
+        self.shard_size = 0
+        self.parity = [np.zeros(0, dtype=np.uint8) for _ in range(parity_count)]
+
+    def add(self, path: str):
+        """Fold the next data shard into the parity shards"""
+        if self.data_count + self.parity_count >= MAX_SHARDS:
+            raise ValueError(f"At most {MAX_SHARDS - self.parity_count} segments can be protected by parity")
+
+        size = os.path.getsize(path)
+        if size > self.shard_size:
+            # Earlier shards are implicitly zero beyond their end, so the parity grows with zeros
+            self.parity = [np.concatenate([p, np.zeros(size - self.shard_size, dtype=np.uint8)]) for p in self.parity]
+            self.shard_size = size
+
+        rows = [self.table[parity_coefficient(j, self.data_count)] for j in range(self.parity_count)]
+        with open(path, 'rb') as f:
+            for start in range(0, size, COLUMN_BLOCK_SIZE):
+                block = _read_block(f, min(COLUMN_BLOCK_SIZE, size - start))
+                for parity, row in zip(self.parity, rows):
+                    parity[start:start + len(block)] ^= row[block]
+        self.data_count += 1
+
+    def shards(self) -> List[bytes]:
+        return [parity.tobytes() for parity in self.parity]
+
+def _invert(matrix: List[List[int]]) -> List[List[int]]:
+    """Gauss-Jordan inversion over GF(256)"""
+    size = len(matrix)
+    rows = [list(row) + [1 if i == j else 0 for j in range(size)] for i, row in enumerate(matrix)]
+    for column in range(size):
+        pivot = next(r for r in range(column, size) if rows[r][column])
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        scale = gf_inv(rows[column][column])
+        rows[column] = [gf_mul(scale, value) for value in rows[column]]
+        for r in range(size):
+            factor = rows[r][column]
+            if r != column and factor:
+                rows[r] = [value ^ gf_mul(factor, pivot_value) for value, pivot_value in zip(rows[r], rows[column])]
+    return [row[size:] for row in rows]
+
+def rebuild_shards(shard_size: int, data_files: Dict[int, str], parity_files: Dict[int, Dict], output_files: Dict[int, str]):
+    """Rebuild missing data shards from the data shards and parity shards that arrived.
+
+    data_files maps data indices to segment files, parity_files maps parity
+    indices to {'path', 'offset'} (where the shard starts in the file) and
+    output_files maps each missing data index to the path to write it to.
+    Needs at least as many parity shards as missing data shards; shards
+    are processed in column blocks, so memory does not grow with the file.
+    """
+    table = _multiplication_table()
+    missing = sorted(output_files)
+    if len(parity_files) < len(missing):
+        raise ValueError(f"{len(missing)} segments missing but only {len(parity_files)} parity segments available")
+
+    used_parity = sorted(parity_files)[:len(missing)]
+    decode = _invert([[parity_coefficient(j, m) for m in missing] for j in used_parity])
+
+    handles = {}
+    try:
+        for i, path in data_files.items():
+            handles[('data', i)] = open(path, 'rb')
+        for j in used_parity:
+            f = open(parity_files[j]['path'], 'rb')
+            f.seek(parity_files[j]['offset'])
+            handles[('parity', j)] = f
+        for m in missing:
+            handles[('out', m)] = open(output_files[m], 'wb')
+
+        for start in range(0, shard_size, COLUMN_BLOCK_SIZE):
+            length = min(COLUMN_BLOCK_SIZE, shard_size - start)
+            # Syndromes: each used parity shard minus the contribution of the data shards we have
+            syndromes = [_read_block(handles[('parity', j)], length) for j in used_parity]
+            for i in data_files:
+                f = handles[('data', i)]
+                f.seek(start)
+                block = _read_block(f, length)
+                for syndrome, j in zip(syndromes, used_parity):
+                    syndrome ^= table[parity_coefficient(j, i)][block]
+
+            for m, coefficients in zip(missing, decode):
+                block = np.zeros(length, dtype=np.uint8)
+                for coefficient, syndrome in zip(coefficients, syndromes):
+                    block ^= table[coefficient][syndrome]
+                handles[('out', m)].write(block.tobytes())
+    finally:
+        for f in handles.values():
+            f.close()
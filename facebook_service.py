@@ -1,20 +1,26 @@
 # import requests
 import json
 import os
-import time
 import requests
 from config import *
 import concurrent.futures
 import threading
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
+from rate_limiter import shared_rate_limiter
+from http_transport import create_session
+from graph_batch import execute_batch, graph_request
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 
 class FacebookService:
-    def __init__(self, access_token: str):
+    def __init__(self, access_token: str, max_upload_workers: int = 3,
+                 session: Optional[requests.Session] = None):
         self.access_token = access_token
-        self.base_url = "https://graph.facebook.com/v19.0"
-        self.upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+        self.base_url = GRAPH_API_URL
+        self.upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_upload_workers)
+        # One pooled keep-alive session for every call, so requests reuse TCP and TLS connections
+        self.session = session or create_session(pool_size=max_upload_workers + 2)
         self.lock = threading.Lock()
+        self.rate_limiter = shared_rate_limiter(GRAPH_API_RATE_LIMITS)
     
     def debug_request(self, response: requests.Response):
         """Debug API requests"""
@@ -25,39 +31,12 @@ class FacebookService:
             print(f"Response Text: {response.text}")
     
     def make_api_request(self, url: str, params: Dict, method: str = 'GET', 
-                        data: Optional[Dict] = None, files: Optional[Dict] = None) -> Dict[str, Any]:
-        """Make API request with error handling and retry logic"""
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                if 'access_token' not in params:
-                    params['access_token'] = self.access_token
-                
-                with requests.Session() as session:
-                    if method.upper() == 'GET':
-                        response = session.get(url, params=params, timeout=30)
-                    elif method.upper() == 'POST':
-                        response = session.post(url, params=params, data=data, files=files, timeout=30)
-                    else:
-                        return {'error': f'Unsupported HTTP method: {method}'}
-                
-                if response.status_code == 429:  # Rate limited
-                    wait_time = 2 ** attempt
-                    print(f"Rate limited. Waiting {wait_time} seconds before retry...")
-                    time.sleep(wait_time)
-                    continue
-                    
-                if response.status_code != 200:
-                    return {'error': f'API Error {response.status_code}: {response.text}'}
-                    
-                return response.json()
-            except requests.exceptions.RequestException as e:
-                if attempt == max_retries - 1:
-                    print(f"Request failed after {max_retries} attempts: {e}")
-                    return {'error': str(e)}
-                wait_time = 2 ** attempt
-                time.sleep(wait_time)
-        return {'error': 'Max retries exceeded'}
+                        data: Optional[Dict] = None, files: Optional[Dict] = None,
+                        endpoint: Optional[str] = None) -> Dict[str, Any]:
+        """Make API request with error handling and retry logic; endpoint selects the rate limiter bucket"""
+        if 'access_token' not in params:
+            params['access_token'] = self.access_token
+        return graph_request(self.session, self.rate_limiter, url, params, method, data, files, endpoint)
     
     def get_conversations(self, limit: int = 20) -> Dict[str, Any]:
         """Get list of conversations"""
@@ -108,7 +87,7 @@ class FacebookService:
         try:
             with open(file_path, 'rb') as file:
                 files = {'filedata': (os.path.basename(file_path), file)}
-                response = self.make_api_request(url, params, 'POST', data=data, files=files)
+                response = self.make_api_request(url, params, 'POST', data=data, files=files, endpoint='upload')
             
             if 'error' in response:
                 return response
@@ -145,17 +124,21 @@ class FacebookService:
         
         return results
     
-    def send_attachment(self, recipient_id: str, attachment_id: str, 
-                       attachment_type: str = 'file') -> Dict[str, Any]:
-        """Send attachment using attachment ID with proper messaging tags"""
-        url = f"{self.base_url}/me/messages"
-        
-        params = {
-            'access_token': self.access_token
-        }
-        
-        # Use the correct messaging tag for file transfers
-        payload = {
+    def batch_request(self, calls: List[Dict[str, Any]], endpoint: str = 'read') -> List[Dict[str, Any]]:
+        """Run many calls through the Graph batch endpoint, one result per call in order"""
+        return execute_batch(
+            self.session,
+            self.rate_limiter,
+            self.base_url,
+            self.access_token,
+            calls,
+            endpoint,
+            batch_size=GRAPH_BATCH_SIZE
+        )
+    
+    def attachment_payload(self, recipient_id: str, attachment_id: str, attachment_type: str = 'file') -> Dict[str, str]:
+        """Message body sending an uploaded attachment, with the messaging tag used for file transfers"""
+        return {
             'recipient': json.dumps({'id': recipient_id}),
             'message': json.dumps({
                 'attachment': {
@@ -168,7 +151,26 @@ class FacebookService:
             'messaging_type': 'MESSAGE_TAG',
             'tag': 'HUMAN_AGENT'
         }
+    
+    def text_payload(self, recipient_id: str, message_text: str) -> Dict[str, str]:
+        """Message body sending plain text with proper tagging"""
+        return {
+            'recipient': json.dumps({'id': recipient_id}),
+            'message': json.dumps({'text': message_text}),
+            'messaging_type': 'MESSAGE_TAG',
+            'tag': 'HUMAN_AGENT'
+        }
+    
+    def send_attachment(self, recipient_id: str, attachment_id: str, 
+                       attachment_type: str = 'file') -> Dict[str, Any]:
+        """Send attachment using attachment ID with proper messaging tags"""
+        url = f"{self.base_url}/me/messages"
         
+        params = {
+            'access_token': self.access_token
+        }
+        
+        payload = self.attachment_payload(recipient_id, attachment_id, attachment_type)
         return self.make_api_request(url, params, 'POST', data=payload)
     
     def send_attachment_with_message(self, recipient_id: str, attachment_id: str, 
@@ -183,6 +185,39 @@ class FacebookService:
         attachment_result = self.send_attachment(recipient_id, attachment_id, attachment_type)
         return attachment_result
     
+    def send_attachments_with_messages(self, recipient_id: str, items: List[Tuple[str, str]],
+                                       attachment_type: str = 'file') -> List[Dict[str, Any]]:
+        """Send (attachment_id, message_text) pairs through batch requests, one result per pair.
+        
+        Each attachment depends on its text message, so Graph sends it only
+        after the text and the pair arrives in order; as with
+        send_attachment_with_message, a failed text keeps its attachment
+        from being sent.
+        """
+        calls = []
+        for number, (attachment_id, message_text) in enumerate(items):
+            calls.append({
+                'method': 'POST',
+                'relative_url': 'me/messages',
+                'body': self.text_payload(recipient_id, message_text),
+                'name': f'text{number}'
+            })
+            calls.append({
+                'method': 'POST',
+                'relative_url': 'me/messages',
+                'body': self.attachment_payload(recipient_id, attachment_id, attachment_type),
+                'depends_on': f'text{number}'
+            })
+        
+        results = self.batch_request(calls, endpoint='send')
+        
+        sent = []
+        for text_result, attachment_result in zip(results[0::2], results[1::2]):
+            if 'error' in text_result:
+                attachment_result = {'error': f"Text message failed: {text_result['error']}"}
+            sent.append(attachment_result)
+        return sent
+    
     def send_text_message(self, recipient_id: str, message_text: str) -> Dict[str, Any]:
         """Send text message with proper tagging"""
         url = f"{self.base_url}/me/messages"
@@ -191,13 +226,7 @@ class FacebookService:
             'access_token': self.access_token
         }
         
-        payload = {
-            'recipient': json.dumps({'id': recipient_id}),
-            'message': json.dumps({'text': message_text}),
-            'messaging_type': 'MESSAGE_TAG',
-            'tag': 'HUMAN_AGENT'
-        }
-        
+        payload = self.text_payload(recipient_id, message_text)
         return self.make_api_request(url, params, 'POST', data=payload)
     
     def verify_token(self) -> Dict[str, Any]:
@@ -249,37 +278,37 @@ class FacebookService:
             ))
             
             # Download the file with streaming
-            response = requests.get(download_url, stream=True, timeout=60)
-            
-            if response.status_code != 200:
-                print(f"Download failed: HTTP {response.status_code}")
-                # Try to get error details
-                try:
-                    error_data = response.json()
-                    print(f"Facebook error: {error_data}")
-                except:
-                    print(f"Response text: {response.text}")
-                return None
-            
-            # Get file size for progress tracking
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded_size = 0
-            
-            with open(file_path, 'wb') as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        file.write(chunk)
-                        downloaded_size += len(chunk)
-                        
-                        # Show progress for large files
-                        if total_size > 0:
-                            progress = (downloaded_size / total_size) * 100
-                            if int(progress) % 10 == 0:  # Print every 10%
-                                print(f"Download progress: {progress:.1f}%")
-            
-            file_size = os.path.getsize(file_path)
-            print(f"Successfully downloaded: {safe_name} ({file_size} bytes)")
-            return file_path
+            response = self.session.get(download_url, stream=True, timeout=60)
+            with response:
+                if response.status_code != 200:
+                    print(f"Download failed: HTTP {response.status_code}")
+                    # Try to get error details
+                    try:
+                        error_data = response.json()
+                        print(f"Facebook error: {error_data}")
+                    except:
+                        print(f"Response text: {response.text}")
+                    return None
+                
+                # Get file size for progress tracking
+                total_size = int(response.headers.get('content-length', 0))
+                downloaded_size = 0
+                
+                with open(file_path, 'wb') as file:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        if chunk:
+                            file.write(chunk)
+                            downloaded_size += len(chunk)
+                            
+                            # Show progress for large files
+                            if total_size > 0:
+                                progress = (downloaded_size / total_size) * 100
+                                if int(progress) % 10 == 0:  # Print every 10%
+                                    print(f"Download progress: {progress:.1f}%")
+                
+                file_size = os.path.getsize(file_path)
+                print(f"Successfully downloaded: {safe_name} ({file_size} bytes)")
+                return file_path
             
         except requests.exceptions.Timeout:
             print(f"Download timed out: {safe_name}")
@@ -0,0 +1,207 @@
+import json
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlencode
+import requests
+from requests.structures import CaseInsensitiveDict
+from rate_limiter import RateLimiter
+
+# The Graph API accepts at most 50 calls per batch request
+MAX_BATCH_SIZE = 50
+
+# Per-call statuses worth retrying in a later batch, for calls that are safe to repeat
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# Calls that can be repeated without side effects; a repeated POST to me/messages sends twice
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+# A call rejected by rate limiting; it was not executed and is always retried
+THROTTLED = 'throttled'
+
+# A null item or 5xx: the call may or may not have been executed
+INCOMPLETE = 'incomplete'
+
+def graph_request(session: requests.Session, rate_limiter: RateLimiter, url: str, params: Dict[str, Any],
+                  method: str = 'GET', data: Optional[Dict] = None, files: Optional[Dict] = None,
+                  endpoint: Optional[str] = None, max_retries: int = 5) -> Dict[str, Any]:
+    """Make one rate-limited Graph API request, retrying while it is throttled.
+
+    endpoint selects the rate limiter bucket ('upload', 'send' or 'read');
+    by default GET requests are reads and POST requests are sends.
+    """
+    if endpoint is None:
+        endpoint = 'read' if method.upper() == 'GET' else 'send'
+
+    for _ in range(max_retries):
+        try:
+            # Rewind uploads so a retry sends the whole file again
+            for file_tuple in (files or {}).values():
+                file_tuple[1].seek(0)
+
+            rate_limiter.acquire(endpoint)
+            if method.upper() == 'GET':
+                response = session.get(url, params=params, timeout=30)
+            elif method.upper() == 'POST':
+                response = session.post(url, params=params, data=data, files=files, timeout=30)
+            else:
+                return {'error': f'Unsupported HTTP method: {method}'}
+
+            # The limiter waits out throttling before the next acquire
+            if rate_limiter.observe(endpoint, response):
+                continue
+
+            if response.status_code != 200:
+                return {'error': f'API Error {response.status_code}: {response.text}'}
+
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            # Connection errors and transient 5xx were already retried by the transport
+            print(f"Request failed: {e}")
+            return {'error': str(e)}
+    return {'error': 'Max retries exceeded'}
+
+def execute_batch(session: requests.Session, rate_limiter: RateLimiter, base_url: str, access_token: str,
+                  calls: List[Dict[str, Any]], endpoint: str, batch_size: int = MAX_BATCH_SIZE,
+                  max_attempts: int = 5) -> List[Dict[str, Any]]:
+    """Run Graph API calls through the batch endpoint, up to batch_size calls per HTTP request.
+
+    Each call is a dict with 'method', 'relative_url' (relative to base_url)
+    and an optional 'body' dict. A call may carry a 'name' and another call
+    a 'depends_on' naming it; Graph then runs the dependent call only after
+    the named one succeeded, and both always go in the same batch. Returns
+    one result per call, in order: the decoded response body or
+    {'error': ...}.
+
+    Throttled calls were not executed and are retried in a later batch.
+    Calls that hit a 5xx or came back null may already have run, so only
+    idempotent (GET) calls are retried; the others report an error rather
+    than risk sending a message twice. Any other failure only affects its
+    own call.
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(calls)
+    names = {call['name']: i for i, call in enumerate(calls) if call.get('name')}
+    pending = list(range(len(calls)))
+
+    for _ in range(max_attempts):
+        retry = set()
+        for indices in _split_batches(pending, calls, batch_size):
+            for _ in indices:
+                rate_limiter.acquire(endpoint)
+
+            items = _post_batch(session, rate_limiter, base_url, access_token,
+                                [calls[i] for i in indices], endpoint)
+            if isinstance(items, dict):
+                outcomes = [(items, items.get('retry'))] * len(indices)
+            else:
+                outcomes = [_parse_item(rate_limiter, item) for item in items]
+                # Throttled calls in one batch count as a single throttling event
+                if any(state == THROTTLED for _, state in outcomes):
+                    rate_limiter.throttled(endpoint)
+
+            for i, (result, state) in zip(indices, outcomes):
+                if state == THROTTLED or (state == INCOMPLETE and _is_idempotent(calls[i])):
+                    retry.add(i)
+                elif state == INCOMPLETE:
+                    results[i] = {'error': f"{result['error']} (not retried, the call may already have been executed)"}
+                else:
+                    results[i] = {'error': result['error']} if 'error' in result else result
+
+            # A call whose dependency is retried did not run either, so it goes along
+            for i in indices:
+                if i not in retry and names.get(calls[i].get('depends_on')) in retry and 'error' in results[i]:
+                    retry.add(i)
+
+        pending = sorted(retry)
+        for i in pending:
+            results[i] = None
+        if not pending:
+            break
+
+    for i in pending:
+        results[i] = {'error': 'Max retries exceeded'}
+    return results
+
+def _is_idempotent(call: Dict[str, Any]) -> bool:
+    return call['method'].upper() in IDEMPOTENT_METHODS
+
+def _split_batches(indices: List[int], calls: List[Dict[str, Any]], batch_size: int) -> List[List[int]]:
+    """Split call indices into batches of at most batch_size, never separating a call from the one it depends on"""
+    groups: List[List[int]] = []
+    for i in indices:
+        depends_on = calls[i].get('depends_on')
+        if depends_on and groups and any(calls[j].get('name') == depends_on for j in groups[-1]):
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+
+    batches: List[List[int]] = []
+    for group in groups:
+        if not batches or len(batches[-1]) + len(group) > batch_size:
+            batches.append([])
+        batches[-1].extend(group)
+    return batches
+
+def _post_batch(session, rate_limiter, base_url, access_token, calls, endpoint):
+    """Send one batch request; returns the list of per-call items, or an error dict for the whole batch"""
+    names = {call['name'] for call in calls if call.get('name')}
+    batch = []
+    for call in calls:
+        entry = {'method': call['method'], 'relative_url': call['relative_url']}
+        if call.get('body'):
+            entry['body'] = urlencode(call['body'])
+        if call.get('name'):
+            entry['name'] = call['name']
+            # Graph drops the response of a call others depend on unless told to keep it
+            entry['omit_response_on_success'] = False
+        # A dependency that already ran in an earlier batch is satisfied
+        if call.get('depends_on') in names:
+            entry['depends_on'] = call['depends_on']
+        batch.append(entry)
+
+    try:
+        response = session.post(
+            base_url,
+            data={'access_token': access_token, 'include_headers': 'true', 'batch': json.dumps(batch)},
+            timeout=60
+        )
+    except requests.exceptions.RequestException as e:
+        # Connection errors were already retried by the transport; anything
+        # later may have been executed, so the calls are not sent again
+        return {'error': str(e)}
+
+    # A throttled batch request is rejected as a whole before any call runs
+    if rate_limiter.observe(endpoint, response):
+        return {'error': 'Rate limited', 'retry': THROTTLED}
+    if response.status_code in RETRY_STATUSES:
+        return {'error': f'API Error {response.status_code}', 'retry': INCOMPLETE}
+    if response.status_code != 200:
+        return {'error': f'API Error {response.status_code}: {response.text}'}
+
+    try:
+        items = response.json()
+    except ValueError:
+        return {'error': 'Invalid batch response'}
+    if not isinstance(items, list) or len(items) != len(calls):
+        return {'error': 'Batch response does not match the request'}
+    return items
+
+def _parse_item(rate_limiter, item):
+    """Decode one batch item into (result, state), where state is None, THROTTLED or INCOMPLETE"""
+    # A null item was not completed, typically because the batch timed out
+    if item is None:
+        return {'error': 'Call did not complete'}, INCOMPLETE
+
+    code = item.get('code', 0)
+    headers = CaseInsensitiveDict({h['name']: h['value'] for h in item.get('headers') or [] if 'name' in h})
+    try:
+        body = json.loads(item.get('body') or 'null')
+    except ValueError:
+        body = None
+
+    rate_limiter.record_usage(headers)
+    if rate_limiter.is_throttled(code, body):
+        return {'error': f'API Error {code}: rate limited'}, THROTTLED
+    if code in RETRY_STATUSES:
+        return {'error': f"API Error {code}: {item.get('body', '')}"}, INCOMPLETE
+    if code != 200:
+        return {'error': f"API Error {code}: {item.get('body', '')}"}, None
+    return (body if isinstance(body, dict) else {'data': body}), None
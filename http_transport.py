@@ -0,0 +1,32 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Transient server errors worth retrying; 429 is left to the rate limiter
+RETRY_STATUSES = (500, 502, 503, 504)
+
+def create_session(pool_size: int = 10, retries: int = 3, backoff_factor: float = 0.5) -> requests.Session:
+    """Build a keep-alive session whose connection pool holds pool_size connections per host.
+
+    Connection errors are retried for every method, since the request never
+    reached the server; read errors and 5xx responses only for idempotent
+    GET and HEAD requests. The session is shared between threads, so callers
+    must not change its headers, cookies or adapters after creation.
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
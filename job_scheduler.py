@@ -0,0 +1,124 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+class SchedulerFull(Exception):
+    """Raised when a job cannot be admitted; retry_after is a hint in seconds"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class JobScheduler:
+    """Run jobs on a fixed pool of workers from a bounded priority queue.
+
+    Admission control rejects new jobs once the queue holds max_queued jobs
+    or max_queued_bytes of estimated work, so the server keeps a steady
+    throughput under overload instead of starting unbounded threads.
+    Lower priority values run first; equal priorities run in arrival order.
+    """
+
+    # Used for Retry-After until real jobs have been timed
+    DEFAULT_JOB_SECONDS = 30.0
+
+    def __init__(self, max_workers: int = 4, max_queued: int = 32, max_queued_bytes: int = 0,
+                 stage_limits: Optional[Dict[str, int]] = None):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_queued_bytes = max_queued_bytes
+        self.stage_semaphores = {
+            stage: threading.BoundedSemaphore(limit) for stage, limit in (stage_limits or {}).items()
+        }
+
+        self._queue = []
+        self._queued_bytes = 0
+        self._running = 0
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+        # Moving averages of completed jobs, used to estimate Retry-After
+        self._avg_job_seconds = None
+        self._avg_bytes_per_second = None
+
+        self._workers = []
+        for i in range(max_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"job-worker-{i+1}")
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, job_id: str, func: Callable, args: Tuple = (), priority: int = 0,
+               estimated_bytes: int = 0) -> int:
+        """Queue a job, returning its position in the queue, or raise SchedulerFull"""
+        with self._condition:
+            self._check_admission(estimated_bytes)
+            entry = (priority, next(self._sequence), job_id, func, args, estimated_bytes)
+            heapq.heappush(self._queue, entry)
+            self._queued_bytes += estimated_bytes
+            self._condition.notify()
+            return sum(1 for queued in self._queue if queued[:2] <= entry[:2])
+
+    def check_admission(self, estimated_bytes: int = 0):
+        """Raise SchedulerFull if a job of estimated_bytes would be rejected right now"""
+        with self._condition:
+            self._check_admission(estimated_bytes)
+
+    def _check_admission(self, estimated_bytes: int):
+        if len(self._queue) >= self.max_queued:
+            raise SchedulerFull("Job queue is full", self._retry_after())
+
+        # A single oversized job is still accepted when nothing else is waiting
+        if (self.max_queued_bytes and self._queue
+                and self._queued_bytes + estimated_bytes > self.max_queued_bytes):
+            raise SchedulerFull("Queued work limit reached", self._retry_after())
+
+    @contextmanager
+    def stage_slot(self, stage: str):
+        """Hold one of the concurrency slots configured for a pipeline stage"""
+        semaphore = self.stage_semaphores.get(stage)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+
+    def _retry_after(self) -> int:
+        """Estimate how long until the queue has room again (caller holds the lock)"""
+        if self._avg_bytes_per_second and self._queued_bytes:
+            seconds = self._queued_bytes / (self._avg_bytes_per_second * self.max_workers)
+        else:
+            job_seconds = self._avg_job_seconds or self.DEFAULT_JOB_SECONDS
+            seconds = job_seconds * max(1, len(self._queue)) / self.max_workers
+        return max(1, min(600, math.ceil(seconds)))
+
+    def _record_completion(self, seconds: float, estimated_bytes: int):
+        def average(current, sample):
+            return sample if current is None else current * 0.8 + sample * 0.2
+
+        with self._condition:
+            self._avg_job_seconds = average(self._avg_job_seconds, seconds)
+            if estimated_bytes and seconds > 0:
+                self._avg_bytes_per_second = average(self._avg_bytes_per_second, estimated_bytes / seconds)
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                _, _, job_id, func, args, estimated_bytes = heapq.heappop(self._queue)
+                self._queued_bytes -= estimated_bytes
+                self._running += 1
+
+            start_time = time.time()
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Job {job_id} crashed: {e}")
+            finally:
+                with self._condition:
+                    self._running -= 1
+                self._record_completion(time.time() - start_time, estimated_bytes)
@@ -0,0 +1,49 @@
+import base64
+import functools
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+# Fixed salt for the master key. Both sides must agree on it, and per-file
+# randomness comes from the salt fed into HKDF below.
+MASTER_KEY_SALT = b'facebook-file-transfer/master-key/v1'
+MASTER_KEY_ITERATIONS = 100000
+
+# Number of distinct passwords whose master keys are kept per process
+MASTER_KEY_CACHE_SIZE = 8
+
+AEAD_KEY_INFO = b'facebook-file-transfer/aead-key/v2'
+
+def derive_password_key(password: str, salt: bytes) -> bytes:
+    """Derive a Fernet key straight from the password using PBKDF2 (v1.0 files)"""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=MASTER_KEY_ITERATIONS,
+    )
+    return base64.urlsafe_b64encode(kdf.derive(password.encode()))
+
+@functools.lru_cache(maxsize=MASTER_KEY_CACHE_SIZE)
+def derive_master_key(password: str) -> bytes:
+    """Derive the master key once per process; the expensive PBKDF2 run is cached"""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=MASTER_KEY_SALT,
+        iterations=MASTER_KEY_ITERATIONS,
+    )
+    return kdf.derive(password.encode())
+
+def _expand_master_key(password: str, salt: bytes, info: bytes) -> bytes:
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        info=info,
+    )
+    return hkdf.derive(derive_master_key(password))
+
+def derive_aead_key(password: str, salt: bytes) -> bytes:
+    """Derive a raw 256-bit per-file AES-GCM key (format v2) from the cached master key"""
+    return _expand_master_key(password, salt, AEAD_KEY_INFO)
@@ -0,0 +1,221 @@
+import abc
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from sqlite_connection import ThreadLocalConnection
+
+# Operations in these states are finished and may be evicted
+TERMINAL_STATUSES = ('completed', 'error')
+
+class OperationStore(abc.ABC):
+    """Keeps the state of download operations keyed by batch_id.
+
+    Operations are plain dicts. Readers get copies, and writers go through
+    create() and update(), so every backend sees each change. Every write
+    bumps the operation's 'version', which wait_for_change() watches.
+    """
+
+    # Seconds between reads while waiting on a backend that cannot notify
+    POLL_INTERVAL = 0.25
+
+    @abc.abstractmethod
+    def create(self, batch_id: str, operation: Dict[str, Any]):
+        """Store a new operation"""
+
+    @abc.abstractmethod
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """Return a copy of the operation, or None if it does not exist or expired"""
+
+    @abc.abstractmethod
+    def update(self, batch_id: str, **fields):
+        """Merge fields into the operation and bump its version"""
+
+    @abc.abstractmethod
+    def delete(self, batch_id: str):
+        """Remove the operation"""
+
+    def wait_for_change(self, batch_id: str, version: int, timeout: float) -> Optional[Dict[str, Any]]:
+        """Return the operation once its version differs from `version`, or as it is after timeout seconds.
+
+        Returns None if the operation does not exist.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            operation = self.get(batch_id)
+            if operation is None or operation.get('version') != version:
+                return operation
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return operation
+            time.sleep(min(self.POLL_INTERVAL, remaining))
+
+    def __contains__(self, batch_id: str) -> bool:
+        return self.get(batch_id) is not None
+
+class MemoryOperationStore(OperationStore):
+    """In-process store with a TTL and a size limit for finished operations.
+
+    Operations are kept in the order they were last written, so the least
+    recently updated ones sit at the head and expiry and eviction only look
+    there instead of scanning every operation.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._operations = OrderedDict()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def create(self, batch_id: str, operation: Dict[str, Any]):
+        with self._lock:
+            self._operations[batch_id] = dict(operation, updated_time=time.time(), version=1)
+            self._evict()
+            self._changed.notify_all()
+
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            operation = self._operations.get(batch_id)
+            if operation is None:
+                return None
+            if self._expired(operation, time.time()):
+                del self._operations[batch_id]
+                return None
+            return dict(operation)
+
+    def update(self, batch_id: str, **fields):
+        with self._lock:
+            operation = self._operations.get(batch_id)
+            if operation is None:
+                return
+            operation.update(fields, updated_time=time.time(), version=operation['version'] + 1)
+            self._operations.move_to_end(batch_id)
+            self._changed.notify_all()
+
+    def delete(self, batch_id: str):
+        with self._lock:
+            self._operations.pop(batch_id, None)
+            self._changed.notify_all()
+
+    def wait_for_change(self, batch_id: str, version: int, timeout: float) -> Optional[Dict[str, Any]]:
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                operation = self._operations.get(batch_id)
+                if operation is None or operation['version'] != version:
+                    return dict(operation) if operation is not None else None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return dict(operation)
+                self._changed.wait(remaining)
+
+    def _expired(self, operation: Dict[str, Any], now: float) -> bool:
+        return operation.get('status') in TERMINAL_STATUSES and now - operation['updated_time'] > self.ttl
+
+    def _evict(self):
+        """Drop expired operations, then least recently updated finished ones over the limit (caller holds the lock)"""
+        now = time.time()
+        # Only the head can be older than the TTL; operations still in progress there are skipped
+        stale = []
+        for batch_id, operation in self._operations.items():
+            if now - operation['updated_time'] <= self.ttl:
+                break
+            if operation.get('status') in TERMINAL_STATUSES:
+                stale.append(batch_id)
+        for batch_id in stale:
+            del self._operations[batch_id]
+
+        if len(self._operations) <= self.max_entries:
+            return
+        for batch_id in list(self._operations):
+            if len(self._operations) <= self.max_entries:
+                break
+            if self._operations[batch_id].get('status') in TERMINAL_STATUSES:
+                del self._operations[batch_id]
+
+class SqliteOperationStore(OperationStore):
+    """SQLite-backed store shared by worker processes and kept across restarts.
+
+    Rows are indexed by batch_id (primary key) and by status; finished
+    operations older than the TTL are purged periodically.
+    """
+
+    # Seconds between purges of expired operations
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path: str = 'operations.db', ttl: float = 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._connection = ThreadLocalConnection(path)
+        self._last_purge = 0.0
+        with self._connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS operations (
+                    batch_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    updated_time REAL NOT NULL,
+                    data TEXT NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_operations_status ON operations (status, updated_time)')
+
+    def create(self, batch_id: str, operation: Dict[str, Any]):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO operations (batch_id, status, updated_time, data) VALUES (?, ?, ?, ?)',
+                (batch_id, operation.get('status', ''), now, json.dumps(dict(operation, version=1)))
+            )
+        self._maybe_purge(now)
+
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute(
+            'SELECT status, updated_time, data FROM operations WHERE batch_id = ?', (batch_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        status, updated_time, data = row
+        if status in TERMINAL_STATUSES and time.time() - updated_time > self.ttl:
+            return None
+        return dict(json.loads(data), updated_time=updated_time)
+
+    def update(self, batch_id: str, **fields):
+        now = time.time()
+        with self._connection() as conn:
+            # BEGIN IMMEDIATE serialises the read-modify-write across processes
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT data FROM operations WHERE batch_id = ?', (batch_id,)).fetchone()
+            if row is None:
+                return
+            operation = json.loads(row[0])
+            operation.update(fields, version=operation.get('version', 0) + 1)
+            conn.execute(
+                'UPDATE operations SET status = ?, updated_time = ?, data = ? WHERE batch_id = ?',
+                (operation.get('status', ''), now, json.dumps(operation), batch_id)
+            )
+
+    def delete(self, batch_id: str):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM operations WHERE batch_id = ?', (batch_id,))
+
+    def _maybe_purge(self, now: float):
+        if now - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        placeholders = ', '.join('?' for _ in TERMINAL_STATUSES)
+        with self._connection() as conn:
+            conn.execute(
+                f'DELETE FROM operations WHERE status IN ({placeholders}) AND updated_time < ?',
+                (*TERMINAL_STATUSES, now - self.ttl)
+            )
+
+def create_operation_store(backend: str = 'memory', path: str = 'operations.db',
+                           ttl: float = 24 * 3600, max_entries: int = 10000) -> OperationStore:
+    """Build the operation store selected in config"""
+    if backend == 'sqlite':
+        return SqliteOperationStore(path, ttl)
+    if backend == 'memory':
+        return MemoryOperationStore(max_entries, ttl)
+    raise ValueError(f"Unknown operation store backend: {backend}")
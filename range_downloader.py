@@ -0,0 +1,289 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+import requests
+from http_transport import create_session
+
+class DownloadError(Exception):
+    """Raised when a download cannot be completed"""
+
+class RangeRestart(Exception):
+    """Raised when the origin ignores a range request or the file changed underneath us"""
+
+class RangeDownloader:
+    """Download a URL into a preallocated local file using parallel HTTP Range requests.
+
+    When the origin sends a validator (ETag or Last-Modified), progress is
+    recorded in a '<path>.state' sidecar, so a failed download resumes from
+    where each range stopped instead of from byte 0. Origins that do not
+    advertise 'Accept-Ranges: bytes' and a Content-Length fall back to a
+    single stream.
+    """
+
+    def __init__(self, session: Optional[requests.Session] = None, connections: int = 4,
+                 min_range_size: int = 4 * 1024 * 1024, max_retries: int = 5, timeout: int = 30):
+        self.session = session or create_session(pool_size=connections)
+        self.connections = connections
+        self.min_range_size = min_range_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+    def probe(self, url: str) -> Dict[str, Any]:
+        """Find the size, range support, validator and content type of a URL with a HEAD request"""
+        try:
+            response = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            return {'size': 0, 'accept_ranges': False, 'validator': '', 'content_type': ''}
+
+        if response.status_code != 200:
+            return {'size': 0, 'accept_ranges': False, 'validator': '', 'content_type': ''}
+
+        try:
+            size = int(response.headers.get('Content-Length', 0))
+        except ValueError:
+            size = 0
+
+        return {
+            'size': size,
+            'accept_ranges': response.headers.get('Accept-Ranges', '').lower() == 'bytes',
+            'validator': response.headers.get('ETag') or response.headers.get('Last-Modified', ''),
+            'content_type': response.headers.get('Content-Type', '')
+        }
+
+    def iter_download(self, url: str, dest_path: str, chunk_size: int = 64 * 1024,
+                      stop_event: Optional[threading.Event] = None,
+                      info: Optional[Dict[str, Any]] = None) -> Iterator[bytes]:
+        """Download url to dest_path, yielding the file's bytes in order as they become contiguous on disk.
+
+        info is the result of an earlier probe() of url; without it the URL is probed first.
+        """
+        if info is None:
+            info = self.probe(url)
+        if not info['accept_ranges'] or info['size'] <= 0:
+            yield from self._iter_single_stream(url, dest_path, chunk_size, stop_event)
+            return
+
+        while True:
+            yielded = 0
+            try:
+                for chunk in self._iter_ranges(url, dest_path, info, chunk_size, stop_event):
+                    yielded += len(chunk)
+                    yield chunk
+                return
+            except RangeRestart as e:
+                if yielded:
+                    raise DownloadError(f"Source changed during download: {e}")
+                # The file changed since the state was saved: start over from scratch
+                self._remove_state(dest_path)
+                info = self.probe(url)
+                if not info['accept_ranges'] or info['size'] <= 0:
+                    yield from self._iter_single_stream(url, dest_path, chunk_size, stop_event)
+                    return
+
+    def _iter_single_stream(self, url, dest_path, chunk_size, stop_event):
+        response = self.session.get(url, stream=True, timeout=self.timeout)
+        if response.status_code != 200:
+            raise DownloadError(f"Failed to download file: HTTP {response.status_code}")
+
+        with response, open(dest_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if stop_event is not None and stop_event.is_set():
+                    raise DownloadError("Download cancelled")
+                if chunk:
+                    f.write(chunk)
+                    yield chunk
+
+    def _iter_ranges(self, url, dest_path, info, chunk_size, stop_event):
+        state = self._load_state(dest_path, url, info)
+        if state is None:
+            state = self._new_state(url, info)
+            with open(dest_path, 'wb') as f:
+                f.truncate(info['size'])
+            self._save_state(dest_path, state)
+        else:
+            print(f"Resuming download of {url} ({self._done_bytes(state)}/{info['size']} bytes already on disk)")
+
+        job = _RangeJob(self, url, dest_path, state, stop_event)
+        job.start()
+        try:
+            # Unbuffered reads, so bytes read ahead of the contiguous end are never cached
+            with open(dest_path, 'rb', buffering=0) as f:
+                position = 0
+                while position < info['size']:
+                    available = job.wait_for_data(position)
+                    while position < available:
+                        data = os.pread(f.fileno(), min(chunk_size, available - position), position)
+                        position += len(data)
+                        yield data
+        finally:
+            job.stop()
+
+        self._remove_state(dest_path)
+
+    def _new_state(self, url, info):
+        """Split the file into up to `connections` ranges of at least min_range_size bytes"""
+        size = info['size']
+        count = max(1, min(self.connections, size // self.min_range_size))
+        range_size = -(-size // count)
+        ranges = []
+        for start in range(0, size, range_size):
+            ranges.append({'start': start, 'end': min(start + range_size, size) - 1, 'done': 0})
+        return {'url': url, 'size': size, 'validator': info['validator'], 'ranges': ranges}
+
+    def _load_state(self, dest_path, url, info):
+        """Return saved progress if it still matches the remote file"""
+        try:
+            with open(dest_path + '.state') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if (state.get('url') != url or state.get('size') != info['size']
+                or state.get('validator') != info['validator'] or not info['validator']):
+            return None
+        if not os.path.exists(dest_path) or os.path.getsize(dest_path) != info['size']:
+            return None
+        return state
+
+    def _save_state(self, dest_path, state):
+        # Without a validator a changed source cannot be detected, so progress is never resumed
+        if not state.get('validator'):
+            return
+        temp_path = dest_path + '.state.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, dest_path + '.state')
+
+    def _remove_state(self, dest_path):
+        try:
+            os.remove(dest_path + '.state')
+        except OSError:
+            pass
+
+    def _done_bytes(self, state):
+        return sum(r['done'] for r in state['ranges'])
+
+class _RangeJob:
+    """Worker threads filling the ranges of one download"""
+
+    # Persist progress after this many bytes per range
+    SAVE_INTERVAL = 4 * 1024 * 1024
+
+    def __init__(self, downloader: RangeDownloader, url: str, dest_path: str,
+                 state: Dict[str, Any], stop_event: Optional[threading.Event]):
+        self.downloader = downloader
+        self.url = url
+        self.dest_path = dest_path
+        self.state = state
+        self.ranges: List[Dict[str, int]] = state['ranges']
+        self.external_stop = stop_event
+        self.stopped = threading.Event()
+        self.error: Optional[Exception] = None
+        self.condition = threading.Condition()
+        self.threads = []
+        self.fd = None
+
+    def start(self):
+        self.fd = os.open(self.dest_path, os.O_WRONLY)
+        for byte_range in self.ranges:
+            if byte_range['done'] < byte_range['end'] - byte_range['start'] + 1:
+                thread = threading.Thread(target=self._fetch_range, args=(byte_range,))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        with self.condition:
+            self.downloader._save_state(self.dest_path, self.state)
+        os.close(self.fd)
+
+    def contiguous_bytes(self) -> int:
+        """Bytes available from offset 0 without gaps (caller holds the condition)"""
+        for byte_range in self.ranges:
+            length = byte_range['end'] - byte_range['start'] + 1
+            if byte_range['done'] < length:
+                return byte_range['start'] + byte_range['done']
+        return self.state['size']
+
+    def wait_for_data(self, position: int) -> int:
+        """Block until data past position is on disk, returning the new contiguous end"""
+        with self.condition:
+            while True:
+                if self.error is not None:
+                    raise self.error
+                if self.external_stop is not None and self.external_stop.is_set():
+                    raise DownloadError("Download cancelled")
+                available = self.contiguous_bytes()
+                if available > position:
+                    return available
+                self.condition.wait(timeout=0.5)
+
+    def _cancelled(self) -> bool:
+        return self.stopped.is_set() or (self.external_stop is not None and self.external_stop.is_set())
+
+    def _fetch_range(self, byte_range: Dict[str, int]):
+        attempt = 0
+        while not self._cancelled():
+            start = byte_range['start'] + byte_range['done']
+            if start > byte_range['end']:
+                return
+            try:
+                self._stream_range(byte_range, start)
+                return
+            except RangeRestart as e:
+                self._fail(e)
+                return
+            except (requests.exceptions.RequestException, DownloadError) as e:
+                attempt += 1
+                if attempt > self.downloader.max_retries:
+                    self._fail(DownloadError(f"Range {start}-{byte_range['end']} failed: {e}"))
+                    return
+                # Retry from the last byte written rather than from the start of the range
+                time.sleep(min(2 ** attempt, 30))
+
+    def _stream_range(self, byte_range: Dict[str, int], start: int):
+        headers = {'Range': f"bytes={start}-{byte_range['end']}"}
+        if self.state['validator']:
+            headers['If-Range'] = self.state['validator']
+
+        response = self.downloader.session.get(self.url, headers=headers, stream=True,
+                                               timeout=self.downloader.timeout)
+        with response:
+            if response.status_code == 200:
+                raise RangeRestart("Origin returned the full file instead of the requested range")
+            if response.status_code != 206:
+                raise DownloadError(f"HTTP {response.status_code}")
+
+            offset = start
+            unsaved = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                if self._cancelled():
+                    return
+                if not chunk:
+                    continue
+                chunk = chunk[:byte_range['end'] + 1 - offset]
+                os.pwrite(self.fd, chunk, offset)
+                offset += len(chunk)
+                unsaved += len(chunk)
+                with self.condition:
+                    byte_range['done'] = offset - byte_range['start']
+                    if unsaved >= self.SAVE_INTERVAL:
+                        self.downloader._save_state(self.dest_path, self.state)
+                        unsaved = 0
+                    self.condition.notify_all()
+                if offset > byte_range['end']:
+                    return
+
+        if offset <= byte_range['end']:
+            raise DownloadError("Connection closed before the range was complete")
+
+    def _fail(self, error: Exception):
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.condition.notify_all()
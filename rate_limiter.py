@@ -0,0 +1,190 @@
+import json
+import threading
+import time
+from typing import Dict, Optional
+import requests
+
+# Graph API error codes that mean "slow down", often returned with HTTP 400 instead of 429
+THROTTLE_ERROR_CODES = {4, 17, 32, 613, 80001, 80006}
+
+# Usage headers report percentages of the quota already used
+USAGE_HEADERS = ('X-App-Usage', 'X-Page-Usage', 'X-Business-Use-Case-Usage')
+
+class TokenBucket:
+    """Hand out tokens at `rate` per second with bursts of up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float, min_rate: float):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.throttle_count = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, tokens: float = 1):
+        """Block until tokens are available, then take them"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                else:
+                    wait = (tokens - self.tokens) / self.rate
+                self.condition.wait(wait)
+
+    def throttled(self, retry_after: Optional[float]):
+        """Halve the rate and stop handing out tokens for retry_after seconds, or an exponential backoff"""
+        with self.condition:
+            self.throttle_count += 1
+            if retry_after is None:
+                retry_after = min(2 ** self.throttle_count, 60)
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def block(self, seconds: float):
+        with self.condition:
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def adjust(self, usage: float, high_watermark: float):
+        """Follow the quota usage reported by the API.
+
+        Above the high watermark the rate shrinks linearly towards min_rate
+        as usage approaches 100%; below it the rate recovers additively
+        towards the configured rate.
+        """
+        with self.condition:
+            self._refill(time.monotonic())
+            if usage >= high_watermark:
+                headroom = max(0.0, (100 - usage) / (100 - high_watermark))
+                self.rate = max(self.min_rate, min(self.rate, self.base_rate * headroom))
+            else:
+                self.throttle_count = 0
+                self.rate = min(self.base_rate, self.rate + self.base_rate * 0.1)
+            self.condition.notify_all()
+
+    def _refill(self, now: float):
+        """Add the tokens earned since the last update (caller holds the condition)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+class RateLimiter:
+    """Process-wide limiter for Graph API calls with one token bucket per endpoint class.
+
+    Callers acquire() before each request and report the response with
+    observe(). 429s and throttling error codes slow down the bucket that
+    hit them; the X-App-Usage / X-Page-Usage headers describe quotas shared
+    by every endpoint, so they adjust all buckets.
+    """
+
+    def __init__(self, rates: Dict[str, float], high_watermark: float = 75.0):
+        self.high_watermark = high_watermark
+        self.buckets = {
+            name: TokenBucket(rate, capacity=max(1.0, rate), min_rate=rate / 20)
+            for name, rate in rates.items()
+        }
+
+    def acquire(self, endpoint: str):
+        bucket = self.buckets.get(endpoint)
+        if bucket is not None:
+            bucket.acquire()
+
+    def observe(self, endpoint: str, response: requests.Response) -> bool:
+        """Feed a response back into the limiter; returns True if the request was throttled and should be retried"""
+        body = None
+        if response.status_code in (400, 403):
+            try:
+                body = response.json()
+            except ValueError:
+                pass
+        return self.observe_result(endpoint, response.status_code, response.headers, body)
+
+    def observe_result(self, endpoint: str, status_code: int, headers, body: Optional[Dict]) -> bool:
+        """Like observe(), for results that did not arrive as their own HTTP response"""
+        self.record_usage(headers)
+        if not self.is_throttled(status_code, body):
+            return False
+        self.throttled(endpoint, self._retry_after(headers))
+        return True
+
+    def record_usage(self, headers):
+        """Adjust every bucket to the quota usage reported in the response headers"""
+        usage, regain_seconds = self._parse_usage(headers)
+        if usage is None:
+            return
+        for bucket in self.buckets.values():
+            bucket.adjust(usage, self.high_watermark)
+            if usage >= 100:
+                bucket.block(regain_seconds or 60)
+
+    def throttled(self, endpoint: str, retry_after: Optional[float] = None):
+        """Slow down the bucket of an endpoint class after it was throttled"""
+        bucket = self.buckets.get(endpoint)
+        if bucket is not None:
+            bucket.throttled(retry_after)
+        print(f"Rate limited on {endpoint} requests, slowing down")
+
+    def is_throttled(self, status_code: int, body: Optional[Dict]) -> bool:
+        if status_code == 429:
+            return True
+        if status_code not in (400, 403) or not isinstance(body, dict):
+            return False
+        error = body.get('error', {})
+        return isinstance(error, dict) and error.get('code') in THROTTLE_ERROR_CODES
+
+    def _retry_after(self, headers) -> Optional[float]:
+        try:
+            return float(headers['Retry-After'])
+        except (KeyError, ValueError):
+            return None
+
+    def _parse_usage(self, headers):
+        """Return the highest usage percentage and the seconds until access is regained, if reported"""
+        usage = None
+        regain_seconds = 0
+        for header in USAGE_HEADERS:
+            value = headers.get(header)
+            if not value:
+                continue
+            try:
+                data = json.loads(value)
+            except ValueError:
+                continue
+
+            # X-Business-Use-Case-Usage nests a list of entries per business id
+            if header == 'X-Business-Use-Case-Usage' and isinstance(data, dict):
+                entries = [entry for items in data.values() if isinstance(items, list) for entry in items]
+            else:
+                entries = [data]
+
+            for entry in entries:
+                if not isinstance(entry, dict):
+                    continue
+                for key in ('call_count', 'total_cputime', 'total_time'):
+                    if isinstance(entry.get(key), (int, float)):
+                        usage = max(usage or 0, entry[key])
+                regain_minutes = entry.get('estimated_time_to_regain_access')
+                if isinstance(regain_minutes, (int, float)):
+                    regain_seconds = max(regain_seconds, regain_minutes * 60)
+        return usage, regain_seconds
+
+_shared_limiter = None
+_shared_lock = threading.Lock()
+
+def shared_rate_limiter(rates: Dict[str, float]) -> RateLimiter:
+    """Return the limiter shared by every Graph API client in this process, creating it on first use"""
+    global _shared_limiter
+    with _shared_lock:
+        if _shared_limiter is None:
+            _shared_limiter = RateLimiter(rates)
+        return _shared_limiter
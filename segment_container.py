@@ -0,0 +1,172 @@
+import base64
+import hashlib
+import json
+import re
+import struct
+from typing import Any, BinaryIO, Dict, NamedTuple, Optional, Tuple
+
+# Segments still start like a PDF so the upload path accepts them, but the
+# payload that follows is raw ciphertext instead of base64 inside a PDF body.
+CONTAINER_PREFIX = b'%PDF-1.4\n'
+CONTAINER_MAGIC = b'%FBXS'
+CONTAINER_VERSION = 2
+CONTAINER_TRAILER = b'\n%%EOF\n'
+
+# magic, version, header size, part index, part count, flags, stream offset, payload length
+HEADER_STRUCT = struct.Struct('>5sBHHHBQQ')
+HEADER_OFFSET = len(CONTAINER_PREFIX)
+
+# Set on the last segment of a stream
+FLAG_FINAL = 0x01
+
+# The manifest part lists the size and SHA-256 of every segment file of a batch
+MANIFEST_MAGIC = b'%FBXM'
+MANIFEST_VERSION = 1
+MANIFEST_SUFFIX = '_manifest.pdf'
+
+# Parity parts hold one Reed-Solomon shard computed over the whole segment files (see erasure)
+PARITY_MAGIC = b'%FBXP'
+# magic, version, parity index, parity count, data count, shard size
+PARITY_HEADER_STRUCT = struct.Struct('>5sBHHHQ')
+PARITY_NAME = re.compile(r'_parity(\d+)\.pdf$', re.IGNORECASE)
+
+class ParityHeader(NamedTuple):
+    parity_index: int
+    parity_count: int
+    data_count: int
+    shard_size: int
+
+    @property
+    def payload_offset(self) -> int:
+        return HEADER_OFFSET + PARITY_HEADER_STRUCT.size
+
+class SegmentHeader(NamedTuple):
+    version: int
+    header_size: int
+    part_index: int
+    part_count: int  # 0 when the total was not yet known as the segment was written
+    flags: int
+    offset: int
+    length: int
+
+    @property
+    def is_final(self) -> bool:
+        return bool(self.flags & FLAG_FINAL)
+
+    @property
+    def payload_offset(self) -> int:
+        return HEADER_OFFSET + self.header_size
+
+def pack_header(part_index: int, part_count: int, flags: int, offset: int, length: int) -> bytes:
+    """Build the binary header written after the PDF prefix"""
+    return HEADER_STRUCT.pack(CONTAINER_MAGIC, CONTAINER_VERSION, HEADER_STRUCT.size,
+                              part_index, part_count, flags, offset, length)
+
+def read_header(f: BinaryIO) -> Optional[SegmentHeader]:
+    """Parse the header of an open segment file, or return None for legacy PDF segments"""
+    f.seek(0)
+    data = f.read(HEADER_OFFSET + HEADER_STRUCT.size)
+    if len(data) < HEADER_OFFSET + HEADER_STRUCT.size or not data.startswith(CONTAINER_PREFIX):
+        return None
+
+    fields = HEADER_STRUCT.unpack_from(data, HEADER_OFFSET)
+    if fields[0] != CONTAINER_MAGIC:
+        return None
+    if fields[1] > CONTAINER_VERSION:
+        raise ValueError(f"Unsupported segment container version: {fields[1]}")
+    return SegmentHeader(*fields[1:])
+
+def read_payload(f: BinaryIO, header: SegmentHeader) -> bytes:
+    """Read the payload of a binary segment by offset"""
+    f.seek(header.payload_offset)
+    payload = f.read(header.length)
+    if len(payload) != header.length:
+        raise ValueError(f"Truncated segment payload: expected {header.length} bytes, got {len(payload)}")
+    return payload
+
+def read_segment(path: str) -> Tuple[Optional[SegmentHeader], bytes]:
+    """Read a segment file, returning its header (None for legacy v1.0 PDF segments) and payload"""
+    with open(path, 'rb') as f:
+        header = read_header(f)
+        if header is not None:
+            return header, read_payload(f, header)
+
+        # Legacy segments keep base64 data in the PDF stream object
+        f.seek(0)
+        content = f.read()
+
+    stream_start = content.find(b'stream\n')
+    stream_end = content.find(b'\nendstream', stream_start)
+    if stream_start == -1 or stream_end == -1:
+        raise ValueError(f"Invalid segment file format: {path}")
+
+    return None, base64.b64decode(content[stream_start + 7:stream_end].strip())
+
+def file_digest(path: str) -> Tuple[int, str]:
+    """Size and SHA-256 hex digest of a file, read in blocks"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+            size += len(block)
+    return size, digest.hexdigest()
+
+def manifest_name(segment_prefix: str) -> str:
+    return f"{segment_prefix}{MANIFEST_SUFFIX}"
+
+def is_manifest_name(name: str) -> bool:
+    return name.lower().endswith(MANIFEST_SUFFIX)
+
+def write_manifest(path: str, manifest: Dict[str, Any]):
+    """Write a manifest part: the PDF prefix, the manifest magic and the manifest as JSON"""
+    with open(path, 'wb') as f:
+        f.write(CONTAINER_PREFIX + MANIFEST_MAGIC + b'\n')
+        f.write(json.dumps(dict(manifest, version=MANIFEST_VERSION)).encode())
+        f.write(CONTAINER_TRAILER)
+
+def read_manifest(path: str) -> Dict[str, Any]:
+    """Parse a manifest part written by write_manifest"""
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    start = len(CONTAINER_PREFIX + MANIFEST_MAGIC + b'\n')
+    if not content.startswith(CONTAINER_PREFIX + MANIFEST_MAGIC) or not content.endswith(CONTAINER_TRAILER):
+        raise ValueError(f"Invalid manifest file: {path}")
+    manifest = json.loads(content[start:-len(CONTAINER_TRAILER)])
+    if manifest.get('version', 0) > MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version: {manifest['version']}")
+    return manifest
+
+def verify_segment(path: str, entry: Dict[str, Any]) -> bool:
+    """Check a downloaded segment against its manifest entry"""
+    size, sha256 = file_digest(path)
+    return size == entry.get('size') and sha256 == entry.get('sha256')
+
+def parity_name(segment_prefix: str, parity_index: int) -> str:
+    return f"{segment_prefix}_parity{parity_index + 1:03d}.pdf"
+
+def is_parity_name(name: str) -> bool:
+    return PARITY_NAME.search(name) is not None
+
+def write_parity(path: str, header: ParityHeader, shard: bytes):
+    """Write a parity part: the PDF prefix, the parity header and the shard"""
+    with open(path, 'wb') as f:
+        f.write(CONTAINER_PREFIX)
+        f.write(PARITY_HEADER_STRUCT.pack(PARITY_MAGIC, CONTAINER_VERSION, *header))
+        f.write(shard)
+        f.write(CONTAINER_TRAILER)
+
+def read_parity_header(path: str) -> ParityHeader:
+    """Parse the header of a parity part written by write_parity"""
+    with open(path, 'rb') as f:
+        data = f.read(HEADER_OFFSET + PARITY_HEADER_STRUCT.size)
+    if len(data) < HEADER_OFFSET + PARITY_HEADER_STRUCT.size or not data.startswith(CONTAINER_PREFIX):
+        raise ValueError(f"Invalid parity file: {path}")
+
+    fields = PARITY_HEADER_STRUCT.unpack_from(data, HEADER_OFFSET)
+    if fields[0] != PARITY_MAGIC:
+        raise ValueError(f"Invalid parity file: {path}")
+    if fields[1] > CONTAINER_VERSION:
+        raise ValueError(f"Unsupported parity container version: {fields[1]}")
+    return ParityHeader(*fields[2:])
@@ -1,19 +1,30 @@
 import os
 import json
 import uuid
-import requests
+import hashlib
+import queue
 import threading
-from flask import Flask, request, jsonify
+import collections
+import multiprocessing
+import concurrent.futures
+from flask import Flask, Response, request, jsonify
 from werkzeug.utils import secure_filename
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-import base64
-import zlib
 import tempfile
 import time
 from facebook_service import FacebookService
-import requests
+from key_derivation import derive_aead_key
+from compression import is_incompressible_type
+from aead_stream import SALT_SIZE, pack_stream_header, seal_chunk
+from operation_store import TERMINAL_STATUSES, create_operation_store
+from range_downloader import RangeDownloader
+from job_scheduler import JobScheduler, SchedulerFull
+from dedup_cache import DedupCache
+from http_transport import create_session
+from segment_container import (
+    CONTAINER_PREFIX, CONTAINER_TRAILER, FLAG_FINAL, HEADER_OFFSET, ParityHeader, file_digest, is_parity_name,
+    manifest_name, pack_header, parity_name, write_manifest, write_parity
+)
+import erasure
 import re
 from config import *
 
@@ -25,88 +36,252 @@ app.secret_key = os.urandom(24)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-facebook_service = FacebookService(PAGE_ACCESS_TOKEN)
+# Shared pool to graph.facebook.com sized for concurrent uploads, sends and reads
+graph_session = create_session(pool_size=sum(STAGE_CONCURRENCY.values()) + MAX_CONCURRENT_JOBS)
+facebook_service = FacebookService(
+    PAGE_ACCESS_TOKEN,
+    max_upload_workers=STAGE_CONCURRENCY['uploading'],
+    session=graph_session
+)
+
+# Bounded job scheduler; encryption concurrency is bounded by the encryptor's process pool
+job_scheduler = JobScheduler(
+    max_workers=MAX_CONCURRENT_JOBS,
+    max_queued=MAX_QUEUED_JOBS,
+    max_queued_bytes=MAX_QUEUED_BYTES,
+    stage_limits={stage: limit for stage, limit in STAGE_CONCURRENCY.items() if stage != 'uploading'}
+)
 
 # Global operation tracking
-operations = {}
+operations = create_operation_store(
+    OPERATION_STORE,
+    path=OPERATION_STORE_PATH,
+    ttl=OPERATION_TTL,
+    max_entries=OPERATION_MAX_ENTRIES
+)
+
+# Attachment_ids of sources that were already uploaded, reused by repeat requests
+dedup_cache = DedupCache(max_entries=DEDUP_CACHE_MAX_ENTRIES, ttl=DEDUP_CACHE_TTL)
 
 class FileEncryptor:
-    def __init__(self, chunk_size=10 * 1024 * 1024):  # 10MB chunks
+    def __init__(self, chunk_size=10 * 1024 * 1024, buffer_size=1024 * 1024, workers=1,
+                 compression_policy='balanced', parity_segments=0):  # 10MB chunks, 1MB blocks
         self.chunk_size = chunk_size
-        self.file_signature = b'ENCRYPTED_FILE_v1.0'
-    
-    def derive_key(self, password, salt):
-        """Derive encryption key from password using PBKDF2"""
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-        )
-        return base64.urlsafe_b64encode(kdf.derive(password.encode()))
+        self.buffer_size = buffer_size
+        self.workers = workers or os.cpu_count() or 1
+        self.compression_policy = compression_policy
+        self.parity_segments = parity_segments
+        if parity_segments and not erasure.available():
+            print("NumPy is not installed, parity segments are disabled")
+            self.parity_segments = 0
+        self._pool = None
+        self._pool_lock = threading.Lock()
     
     def encrypt_file(self, input_file, output_base, password):
         """Encrypt file and split into PDF-like segments"""
+        return self.encrypt_file_streaming(input_file, output_base, password)
+    
+    def encrypt_file_streaming(self, input_file, output_base, password):
+        """Encrypt file block by block so memory stays bounded by buffer_size"""
         try:
-            # Generate random salt
-            salt = os.urandom(16)
-            
-            # Derive encryption key
-            key = self.derive_key(password, salt)
-            fernet = Fernet(key)
-            
-            # Read and compress original file
             with open(input_file, 'rb') as f:
-                original_data = f.read()
-            
-            compressed_data = zlib.compress(original_data)
-            
-            # Encrypt the compressed data
-            encrypted_data = fernet.encrypt(compressed_data)
-            
-            # Create final data with signature, salt, and encrypted data
-            final_data = self.file_signature + salt + encrypted_data
-            
-            # Split into chunks
-            total_chunks = (len(final_data) + self.chunk_size - 1) // self.chunk_size
-            
-            output_files = []
-            for i in range(total_chunks):
-                start = i * self.chunk_size
-                end = min((i + 1) * self.chunk_size, len(final_data))
-                chunk_data = final_data[start:end]
-                
-                # Create PDF-like output (base64 encoded)
-                pdf_like_data = base64.b64encode(chunk_data)
-                
-                # Create output filename with consistent pattern
-                output_file = f"{output_base}_part{i+1:03d}.pdf"
-                output_files.append(output_file)
-                
-                # Write as PDF-like file
-                with open(output_file, 'wb') as f:
-                    f.write(b'%PDF-1.4\n')
-                    f.write(b'%%\xE2\xE3\xCF\xD3\n')
-                    f.write(b'1 0 obj\n<<\n/Type /Catalog\n/Pages 2 0 R\n>>\nendobj\n')
-                    f.write(b'2 0 obj\n<<\n/Type /Pages\n/Kids [3 0 R]\n/Count 1\n>>\nendobj\n')
-                    f.write(b'3 0 obj\n<<\n/Type /Page\n/Parent 2 0 R\n/MediaBox [0 0 612 792]\n/Contents 4 0 R\n>>\nendobj\n')
-                    f.write(b'4 0 obj\n<<\n/Length ' + str(len(pdf_like_data)).encode() + b'\n>>\nstream\n')
-                    f.write(pdf_like_data)
-                    f.write(b'\nendstream\nendobj\n')
-                    f.write(b'xref\n0 5\n0000000000 65535 f \n0000000009 00000 n \n0000000058 00000 n \n0000000115 00000 n \n0000000254 00000 n \n')
-                    f.write(b'trailer\n<<\n/Size 5\n/Root 1 0 R\n>>\nstartxref\n' + str(len(pdf_like_data) + 300).encode() + b'\n%%EOF\n')
-                
-                print(f"Created encrypted segment: {output_file} ({len(chunk_data)} bytes)")
+                chunks = iter(lambda: f.read(self.buffer_size), b'')
+                output_files = list(self.encrypt_chunks(chunks, output_base, password, input_file))
             
-            print(f"Encryption complete! Created {total_chunks} segment(s).")
+            print(f"Encryption complete! Created {len(output_files)} segment(s).")
             return output_files
             
         except Exception as e:
             print(f"Encryption error: {e}")
             return None
+    
+    def encrypt_chunks(self, chunks, output_base, password, file_name='', mime_type=None):
+        """Encrypt an iterable of byte chunks, yielding each segment path as soon as it is complete"""
+        skip_compression = is_incompressible_type(file_name, mime_type)
+        salt = os.urandom(SALT_SIZE)
+        key = derive_aead_key(password, salt)
+        stream_header = pack_stream_header(salt, self.buffer_size)
+        
+        # Every segment starts with the stream header and holds whole chunks,
+        # so the client can decrypt segments independently and in any order
+        writer = SegmentWriter(output_base, self.chunk_size, preamble=stream_header)
+        encoder = erasure.ParityEncoder(self.parity_segments) if self.parity_segments else None
+        
+        def completed():
+            """Finished segments, folded into the parity before they are handed on (and deleted after upload)"""
+            nonlocal encoder
+            for output_file in writer.pop_completed():
+                if encoder is not None:
+                    try:
+                        encoder.add(output_file)
+                    except ValueError as e:
+                        print(f"Skipping parity segments: {e}")
+                        encoder = None
+                yield output_file
+        
+        blocks = self._iter_blocks(chunks)
+        try:
+            for sealed_chunk in self._map_blocks(key, stream_header, blocks, skip_compression):
+                writer.write_record(sealed_chunk)
+                yield from completed()
+        except BaseException:
+            writer.abort()
+            raise
+        
+        writer.close()
+        yield from completed()
+        
+        if encoder is not None:
+            yield from self._write_parity(encoder, output_base)
+    
+    def _write_parity(self, encoder, output_base):
+        """Write the parity segments; any data_count of the data and parity segments rebuild the rest"""
+        for parity_index, shard in enumerate(encoder.shards()):
+            output_file = parity_name(output_base, parity_index)
+            header = ParityHeader(parity_index, encoder.parity_count, encoder.data_count, encoder.shard_size)
+            write_parity(output_file, header, shard)
+            print(f"Created parity segment: {output_file} ({len(shard)} bytes)")
+            yield output_file
+    
+    def _map_blocks(self, key, stream_header, blocks, skip_compression):
+        """Seal blocks in order, spreading them over a process pool when workers > 1"""
+        if self.workers <= 1:
+            for index, block, final in blocks:
+                yield seal_chunk(key, stream_header, index, block, final, self.compression_policy, skip_compression)
+            return
+        
+        pool = self._get_pool()
+        pending = collections.deque()
+        for index, block, final in blocks:
+            pending.append(pool.submit(seal_chunk, key, stream_header, index, block, final,
+                                       self.compression_policy, skip_compression))
+            # Two blocks per worker in flight bound memory to buffer_size * workers
+            if len(pending) >= self.workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # Forking would copy the locks held by this process's other threads into the workers
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver')
+                )
+            return self._pool
+    
+    def _iter_blocks(self, chunks):
+        """Regroup arbitrarily sized chunks into (index, block, final) with blocks of exactly buffer_size bytes"""
+        buffer = bytearray()
+        index = 0
+        for chunk in chunks:
+            buffer += chunk
+            # A full block is only released once more data follows, so the last block is the final one
+            while len(buffer) > self.buffer_size:
+                yield index, bytes(buffer[:self.buffer_size]), False
+                del buffer[:self.buffer_size]
+                index += 1
+        yield index, bytes(buffer), True
+
+class BinarySegment:
+    """Write raw bytes into a single binary container segment (see segment_container)"""
+    
+    def __init__(self, output_file, part_index, offset):
+        self.output_file = output_file
+        self.part_index = part_index
+        self.offset = offset
+        self.raw_size = 0
+        self._file = open(output_file, 'wb')
+        self._file.write(CONTAINER_PREFIX)
+        # Header placeholder, rewritten on close once the payload length is known
+        self._file.write(pack_header(part_index, 0, 0, offset, 0))
+    
+    def write(self, data):
+        self._file.write(data)
+        self.raw_size += len(data)
+    
+    def close(self, final=False):
+        """Write the trailer and the final header; the last part also records the part count"""
+        self._file.write(CONTAINER_TRAILER)
+        part_count = self.part_index if final else 0
+        flags = FLAG_FINAL if final else 0
+        self._file.seek(HEADER_OFFSET)
+        self._file.write(pack_header(self.part_index, part_count, flags, self.offset, self.raw_size))
+        self._file.close()
+    
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.output_file)
+        except OSError:
+            pass
+
+class SegmentWriter:
+    """Split a stream of records across consecutive binary segments of chunk_size bytes"""
+    
+    def __init__(self, output_base, chunk_size, preamble=b''):
+        self.output_base = output_base
+        self.chunk_size = chunk_size
+        self.preamble = preamble
+        self.output_files = []
+        self.bytes_written = 0
+        self._completed = []
+        self._segment = None
+    
+    def write_record(self, record):
+        """Write a record, rolling over to a new segment when it would not fit"""
+        room = self.chunk_size - len(self.preamble)
+        if len(record) > room:
+            raise ValueError(f"Record of {len(record)} bytes does not fit in a {self.chunk_size} byte segment")
+        
+        # A full segment is only finished once the next record arrives, so close() can mark the last one final
+        if self._segment is not None and self._segment.raw_size + len(record) > self.chunk_size:
+            self._finish_segment(final=False)
+        
+        if self._segment is None:
+            part_index = len(self.output_files) + 1
+            output_file = f"{self.output_base}_part{part_index:03d}.pdf"
+            self._segment = BinarySegment(output_file, part_index, self.bytes_written)
+            self.output_files.append(output_file)
+            self._write(self.preamble)
+        
+        self._write(record)
+    
+    def close(self):
+        """Finish the last segment and mark it final"""
+        if self._segment is not None:
+            self._finish_segment(final=True)
+    
+    def abort(self):
+        """Discard the segment being written; finished segments are left to the caller"""
+        if self._segment is not None:
+            self._segment.discard()
+            self._segment = None
+    
+    def pop_completed(self):
+        """Return the segments finished since the last call"""
+        completed, self._completed = self._completed, []
+        return completed
+    
+    def _write(self, data):
+        self._segment.write(data)
+        self.bytes_written += len(data)
+    
+    def _finish_segment(self, final):
+        self._segment.close(final)
+        print(f"Created encrypted segment: {self._segment.output_file} ({self._segment.raw_size} bytes)")
+        self._completed.append(self._segment.output_file)
+        self._segment = None
+
+# Parallel range downloader for source files
+range_downloader = RangeDownloader(
+    session=create_session(pool_size=STAGE_CONCURRENCY['downloading'] * DOWNLOAD_CONNECTIONS),
+    connections=DOWNLOAD_CONNECTIONS
+)
 
 # Initialize encryptor
-file_encryptor = FileEncryptor()
+file_encryptor = FileEncryptor(buffer_size=ENCRYPTION_BUFFER_SIZE, workers=ENCRYPTION_WORKERS,
+                               compression_policy=COMPRESSION_POLICY, parity_segments=PARITY_SEGMENTS)
 
 @app.route('/start_download', methods=['POST'])
 def start_download():
@@ -117,161 +292,632 @@ def start_download():
     if not file_url:
         return jsonify({'error': 'File URL is required'}), 400
     
+    try:
+        priority = int(data.get('priority', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Priority must be an integer'}), 400
+    
+    # Reject cheaply while the queue is full, before spending a request on the probe
+    try:
+        job_scheduler.check_admission()
+    except SchedulerFull as e:
+        response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+        return response, 429, {'Retry-After': str(e.retry_after)}
+    
+    # Estimate the work before admitting the job; the validator identifies this version of the source
+    source = range_downloader.probe(file_url)
+    validator = source['validator']
+    estimated_bytes = source['size']
+    if dedup_cache.lookup_url(file_url, validator):
+        estimated_bytes = 0
+    
     # Create operation ID (this will be our batch ID)
     batch_id = str(uuid.uuid4())
     
     # Store operation
-    operations[batch_id] = {
-        'status': 'downloading',
+    operations.create(batch_id, {
+        'status': 'queued',
         'progress': 0,
-        'current_stage': 'downloading',
+        'current_stage': 'queued',
         'file_url': file_url,
+        'source': source,
+        'segment_prefix': f"enc_{batch_id}",
         'encrypted_files': [],
         'attachment_ids': [],
+        'message_ids': [],
+        'parity_message_ids': [],
+        'estimated_bytes': estimated_bytes,
         'start_time': time.time()
-    }
+    })
     
-    # Start operation in background thread
-    thread = threading.Thread(
-        target=process_download_thread,
-        args=(batch_id, file_url)
-    )
-    thread.daemon = True
-    thread.start()
+    # Queue the operation; the scheduler runs it when a worker is free
+    try:
+        queue_position = job_scheduler.submit(
+            batch_id,
+            process_download_thread,
+            (batch_id, file_url),
+            priority=priority,
+            estimated_bytes=estimated_bytes
+        )
+    except SchedulerFull as e:
+        operations.delete(batch_id)
+        response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+        return response, 429, {'Retry-After': str(e.retry_after)}
     
-    return jsonify({'status': 'started', 'batch_id': batch_id})
+    return jsonify({'status': 'started', 'batch_id': batch_id, 'queue_position': queue_position})
 
 def process_download_thread(batch_id, file_url):
     """Wrapper function to process download in background thread with app context"""
     with app.app_context():
         process_download(batch_id, file_url)
 
-def process_download(batch_id, file_url):
-    """Process download operation with encryption and Facebook upload"""
+class PipelineAborted(Exception):
+    """Raised inside a stage when another stage of the same pipeline has failed"""
+
+class Pipeline:
+    """Runs the stages of one operation concurrently, connected by bounded queues"""
+    
+    END_OF_STREAM = object()
+    
+    def __init__(self, batch_id):
+        self.batch_id = batch_id
+        self.encrypted_files = []
+        self.segment_digests = {}
+        self.attachment_ids = []
+        self.message_ids = []
+        self.parity_message_ids = []
+        self.source_path = None
+        self.content_hash = None
+        self.duplicate_of = None
+        self.source_checked = threading.Event()
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.threads = []
+        self.finished_stages = set()
+        self.lock = threading.Lock()
+    
+    def new_queue(self, maxsize):
+        return queue.Queue(maxsize=maxsize)
+    
+    def put(self, target_queue, item):
+        """Put an item downstream, blocking while the queue is full unless the pipeline fails"""
+        while True:
+            if self.stop_event.is_set():
+                raise PipelineAborted()
+            try:
+                target_queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+    
+    def close(self, target_queue):
+        """Tell the downstream stage that no more items will follow"""
+        self.put(target_queue, self.END_OF_STREAM)
+    
+    def iter_queue(self, source_queue):
+        """Yield items from an upstream stage until it closes the queue"""
+        while True:
+            if self.stop_event.is_set():
+                raise PipelineAborted()
+            try:
+                item = source_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is self.END_OF_STREAM:
+                return
+            yield item
+    
+    def cancel(self):
+        """Stop every stage without recording an error"""
+        self.stop_event.set()
+    
+    def start_stage(self, name, target, *args):
+        thread = threading.Thread(target=self._run_stage, args=(name, target) + args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+    
+    def update(self, **fields):
+        operations.update(self.batch_id, **fields)
+    
+    def add_encrypted_file(self, output_file):
+        # Hashed before the upload stage deletes the file, for the batch manifest
+        size, sha256 = file_digest(output_file)
+        with self.lock:
+            self.segment_digests[output_file] = {'size': size, 'sha256': sha256}
+            self.encrypted_files.append(output_file)
+            self.update(encrypted_files=list(self.encrypted_files))
+    
+    def add_attachment_id(self, attachment_id):
+        with self.lock:
+            self.attachment_ids.append(attachment_id)
+            self.update(attachment_ids=list(self.attachment_ids))
+    
+    def manifest(self):
+        """Part count, size and SHA-256 of every segment and parity segment, in part order"""
+        with self.lock:
+            entries = [
+                dict(self.segment_digests[output_file], name=os.path.basename(output_file))
+                for output_file in self.encrypted_files
+            ]
+        parts = [entry for entry in entries if not is_parity_name(entry['name'])]
+        parity_parts = [entry for entry in entries if is_parity_name(entry['name'])]
+        return {
+            'segment_prefix': f"enc_{self.batch_id}",
+            'part_count': len(parts),
+            'parts': parts,
+            'parity_parts': parity_parts
+        }
+    
+    def add_send_results(self, send_results, output_files):
+        """Record the message ids of delivered segments and parity segments, so clients can fetch them directly"""
+        with self.lock:
+            for output_file, send_result in zip(output_files, send_results):
+                if not send_result.get('message_id'):
+                    continue
+                if is_parity_name(output_file):
+                    self.parity_message_ids.append(send_result['message_id'])
+                else:
+                    self.message_ids.append(send_result['message_id'])
+            self.update(message_ids=list(self.message_ids), parity_message_ids=list(self.parity_message_ids))
+    
+    def finish_stage(self, name):
+        """Record a finished stage and move the operation on to the earliest unfinished one"""
+        with self.lock:
+            self.finished_stages.add(name)
+            fields = {}
+            for stage, progress in PIPELINE_STAGES:
+                if stage not in self.finished_stages:
+                    fields['current_stage'] = stage
+                    fields['status'] = stage
+                    break
+                fields['progress'] = progress
+            else:
+                # The send stage can finish before the upload stage reports back,
+                # so the last stage to finish is not necessarily the last stage
+                last_stage = PIPELINE_STAGES[-1][0]
+                fields['current_stage'] = last_stage
+                fields['status'] = last_stage
+            self.update(**fields)
+    
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+    
+    def _run_stage(self, name, target, *args):
+        try:
+            target(self, *args)
+            self.finish_stage(name)
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            self.errors.append(str(e))
+            self.stop_event.set()
+
+# Stage names in pipeline order with the progress reached once each one finishes
+PIPELINE_STAGES = [
+    ('downloading', 30),
+    ('encrypting', 50),
+    ('uploading', 70),
+    ('sending', 90),
+]
+
+# Bounded queues between stages keep memory flat while the stages overlap
+PIPELINE_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PIPELINE_CHUNK_QUEUE_SIZE = 64
+PIPELINE_SEGMENT_QUEUE_SIZE = 2
+
+def download_stage(pipeline, file_url, source, chunk_queue, check_duplicates):
+    """Stage 1: Stream the source URL into the chunk queue"""
+    print(f"Downloading file from: {file_url}")
+    content_hash = hashlib.sha256()
+    if not check_duplicates:
+        pipeline.source_checked.set()
+    
+    # Ranges land in a local file keyed by URL and validator, so a retried job resumes the download
+    with job_scheduler.stage_slot('downloading'):
+        chunks = range_downloader.iter_download(
+            file_url,
+            pipeline.source_path,
+            chunk_size=PIPELINE_DOWNLOAD_CHUNK_SIZE,
+            stop_event=pipeline.stop_event,
+            info=source
+        )
+        for chunk in chunks:
+            content_hash.update(chunk)
+            pipeline.put(chunk_queue, chunk)
+    
+    print(f"Download complete: {file_url}")
+    pipeline.content_hash = content_hash.hexdigest()
+    
+    # The same bytes may already have been uploaded under another URL or validator
+    if check_duplicates:
+        cached = dedup_cache.lookup_content(pipeline.content_hash)
+        if cached:
+            print(f"Source matches the segments of {cached['segment_prefix']}, reusing them")
+            pipeline.duplicate_of = cached
+            pipeline.cancel()
+            raise PipelineAborted()
+    
+    pipeline.source_checked.set()
+    pipeline.close(chunk_queue)
+
+def encrypt_stage(pipeline, output_base, file_name, mime_type, chunk_queue, segment_queue):
+    """Stage 2: Encrypt chunks as they arrive and pass on each finished segment"""
+    chunks = pipeline.iter_queue(chunk_queue)
+    for output_file in file_encryptor.encrypt_chunks(chunks, output_base, FIXED_PASSWORD, file_name, mime_type):
+        pipeline.add_encrypted_file(output_file)
+        pipeline.put(segment_queue, output_file)
+    
+    if not pipeline.encrypted_files:
+        raise Exception("File encryption failed")
+    
+    pipeline.close(segment_queue)
+
+def upload_stage(pipeline, segment_queue, upload_queue):
+    """Stage 3: Start uploading each segment as soon as it has been written"""
+    futures = []
     try:
-        operation = operations[batch_id]
-        
-        # Stage 1: Download the file from the provided URL
-        operation['current_stage'] = 'downloading'
-        operation['status'] = 'downloading'
-        operation['progress'] = 10
-        
-        print(f"Downloading file from: {file_url}")
+        for output_file in pipeline.iter_queue(segment_queue):
+            future = facebook_service.upload_executor.submit(facebook_service.upload_media, output_file, 'file')
+            futures.append(future)
+            pipeline.put(upload_queue, (output_file, future))
+    except PipelineAborted:
+        # Drop uploads that have not started yet
+        for future in futures:
+            future.cancel()
+        raise
+    
+    pipeline.close(upload_queue)
+    concurrent.futures.wait(futures)
+
+def send_stage(pipeline, batch_id, upload_queue, send_results):
+    """Stage 4: Send uploaded segments in part order with batch ID and attachment ID"""
+    ready = []
+    ready_files = []
+    part_number = 0
+    for output_file, future in pipeline.iter_queue(upload_queue):
+        part_number += 1
+        attachment_id = wait_for_upload(output_file, future)
+        if attachment_id:
+            pipeline.add_attachment_id(attachment_id)
+            ready.append((part_number, attachment_id))
+            ready_files.append(output_file)
         
-        # Download the file
-        response = requests.get(file_url, stream=True, timeout=30)
-        if response.status_code != 200:
-            raise Exception(f"Failed to download file: HTTP {response.status_code}")
+        # Batch whatever is ready once no upload is waiting, but only after the download ruled out a duplicate
+        if ready and pipeline.source_checked.is_set() and upload_queue.empty():
+            results = send_segments(batch_id, ready)
+            pipeline.add_send_results(results, ready_files)
+            send_results.extend(results)
+            ready = []
+            ready_files = []
+    
+    if ready:
+        results = send_segments(batch_id, ready)
+        pipeline.add_send_results(results, ready_files)
+        send_results.extend(results)
+
+def wait_for_upload(output_file, future):
+    """Wait for one segment's upload, returning its attachment_id or None"""
+    try:
+        upload_result = future.result()
+    except Exception as e:
+        upload_result = {'error': str(e)}
+    
+    # The segment is no longer needed once its upload has finished
+    try:
+        os.remove(output_file)
+    except:
+        pass
+    
+    attachment_id = upload_result.get('attachment_id')
+    if not attachment_id:
+        print(f"Upload failed for {output_file}: {upload_result.get('error', 'Unknown error')}")
+    return attachment_id
+
+def send_segments(batch_id, parts):
+    """Send (part_number, attachment_id) pairs with both batch ID and attachment ID in the message"""
+    messages = [
+        (attachment_id, f"Batch: {batch_id}, Attachment: {attachment_id}, Part: {part_number}")
+        for part_number, attachment_id in parts
+    ]
+    
+    with job_scheduler.stage_slot('sending'):
+        if GRAPH_BATCH_SENDS:
+            return facebook_service.send_attachments_with_messages(RECIPIENT_ID, messages, 'file')
         
-        # Save the downloaded file
+        return [
+            facebook_service.send_attachment_with_message(RECIPIENT_ID, attachment_id, 'file', message_text)
+            for attachment_id, message_text in messages
+        ]
+
+def send_manifest(batch_id, manifest):
+    """Upload and send the manifest as its own part after the segments, returning its message id or None"""
+    manifest_file = os.path.join(UPLOAD_FOLDER, manifest_name(manifest['segment_prefix']))
+    try:
+        write_manifest(manifest_file, manifest)
+        upload_result = facebook_service.upload_media(manifest_file, 'file')
+    finally:
+        try:
+            os.remove(manifest_file)
+        except OSError:
+            pass
+    
+    attachment_id = upload_result.get('attachment_id')
+    if not attachment_id:
+        print(f"Manifest upload failed: {upload_result.get('error', 'Unknown error')}")
+        return None
+    
+    with job_scheduler.stage_slot('sending'):
+        send_result = facebook_service.send_attachment_with_message(
+            RECIPIENT_ID, attachment_id, 'file', f"Batch: {batch_id}, Manifest: {attachment_id}"
+        )
+    if 'error' in send_result:
+        print(f"Manifest send failed: {send_result['error']}")
+        return None
+    return send_result.get('message_id')
+
+def send_cached_segments(batch_id, cached):
+    """Send the attachments of an earlier batch with the same source, skipping every other stage"""
+    operations.update(
+        batch_id,
+        current_stage='sending',
+        status='sending',
+        progress=70,
+        segment_prefix=cached['segment_prefix'],
+        encrypted_files=[],
+        attachment_ids=[],
+        message_ids=[],
+        parity_message_ids=[]
+    )
+    
+    parts = list(enumerate(cached['attachment_ids'], 1))
+    send_results = send_segments(batch_id, parts)
+    
+    for (_, attachment_id), send_result in zip(parts, send_results):
+        if 'error' in send_result:
+            print(f"Reused attachment {attachment_id} could not be sent: {send_result['error']}")
+            # Drop the cache entry; the caller then processes the source from scratch
+            dedup_cache.invalidate(cached['content_hash'])
+            operations.update(batch_id, segment_prefix=f"enc_{batch_id}")
+            return False
+    
+    # Parity segments were cached after the data segments
+    manifest = cached.get('manifest')
+    part_count = manifest['part_count'] if manifest else len(parts)
+    message_ids = [r.get('message_id') for r in send_results]
+    operations.update(
+        batch_id,
+        status='completed',
+        progress=100,
+        part_count=part_count,
+        manifest=manifest,
+        attachment_ids=list(cached['attachment_ids']),
+        message_ids=message_ids[:part_count],
+        parity_message_ids=message_ids[part_count:]
+    )
+    print(f"Operation {batch_id} completed from cache. Sent {len(parts)} files.")
+    return True
+
+# Source files being written by running pipelines, so two jobs never share one
+active_source_paths = set()
+active_source_lock = threading.Lock()
+
+def claim_source_path(batch_id, file_url, validator):
+    """Claim the local path for a source download, returning it and whether it can be resumed later"""
+    with active_source_lock:
+        # Only a source with a validator, not in use by another job, can be resumed by a later attempt
+        if validator:
+            source_hash = hashlib.sha256(f"{file_url}\n{validator}".encode()).hexdigest()[:32]
+            path = os.path.join(UPLOAD_FOLDER, f"source_{source_hash}")
+            if path not in active_source_paths:
+                active_source_paths.add(path)
+                return path, True
+        path = os.path.join(UPLOAD_FOLDER, f"source_{batch_id}")
+        active_source_paths.add(path)
+        return path, False
+
+def release_source_path(path, keep):
+    """Give up a claimed source path, removing the file and its .state unless it is kept for resuming"""
+    with active_source_lock:
+        if not keep:
+            for stale_path in (path, path + '.state'):
+                try:
+                    os.remove(stale_path)
+                except OSError:
+                    pass
+        active_source_paths.discard(path)
+
+def expire_stale_sources():
+    """Remove partial sources and .state files of failed jobs that were not resumed within SOURCE_RESUME_TTL"""
+    cutoff = time.time() - SOURCE_RESUME_TTL
+    with active_source_lock:
+        for name in os.listdir(UPLOAD_FOLDER):
+            if not name.startswith('source_'):
+                continue
+            path = os.path.join(UPLOAD_FOLDER, name)
+            if os.path.join(UPLOAD_FOLDER, name.split('.', 1)[0]) in active_source_paths:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+def run_pipeline(batch_id, file_url, source, mime_type, original_filename, check_duplicates):
+    """Run the download, encrypt, upload and send stages for one operation"""
+    # Use consistent filename pattern (this is the key change)
+    output_base = os.path.join(UPLOAD_FOLDER, f"enc_{batch_id}")
+    
+    expire_stale_sources()
+    pipeline = Pipeline(batch_id)
+    pipeline.source_path, resumable = claim_source_path(batch_id, file_url, source['validator'])
+    chunk_queue = pipeline.new_queue(PIPELINE_CHUNK_QUEUE_SIZE)
+    segment_queue = pipeline.new_queue(PIPELINE_SEGMENT_QUEUE_SIZE)
+    upload_queue = pipeline.new_queue(PIPELINE_SEGMENT_QUEUE_SIZE)
+    send_results = []
+    
+    pipeline.start_stage('downloading', download_stage, file_url, source, chunk_queue, check_duplicates)
+    pipeline.start_stage('encrypting', encrypt_stage, output_base, original_filename, mime_type,
+                         chunk_queue, segment_queue)
+    pipeline.start_stage('uploading', upload_stage, segment_queue, upload_queue)
+    pipeline.start_stage('sending', send_stage, batch_id, upload_queue, send_results)
+    pipeline.join()
+    
+    # Clean up any segments left behind by a failed stage
+    for encrypted_file in pipeline.encrypted_files:
+        try:
+            os.remove(encrypted_file)
+        except:
+            pass
+    
+    # The source is only kept after a failure, and only if the next attempt can resume it
+    release_source_path(pipeline.source_path, keep=resumable and bool(pipeline.errors))
+    
+    if pipeline.errors:
+        raise Exception(pipeline.errors[0])
+    
+    return pipeline, send_results
+
+def process_download(batch_id, file_url):
+    """Process download operation with encryption and Facebook upload"""
+    try:
         original_filename = secure_filename(file_url.split('/')[-1]) or "downloaded_file"
-        local_file_path = os.path.join(UPLOAD_FOLDER, f"temp_{batch_id}_{original_filename}")
-        
-        with open(local_file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-        
-        print(f"Download complete: {local_file_path}")
-        operation['progress'] = 30
-        
-        # Stage 2: Encrypt the file
-        operation['current_stage'] = 'encrypting'
-        operation['status'] = 'encrypting'
-        
-        # Use consistent filename pattern (this is the key change)
-        output_base = os.path.join(UPLOAD_FOLDER, f"enc_{batch_id}")
-        encrypted_files = file_encryptor.encrypt_file(local_file_path, output_base, FIXED_PASSWORD)
-        
-        if not encrypted_files:
-            raise Exception("File encryption failed")
-        
-        operation['encrypted_files'] = encrypted_files
-        operation['original_filename'] = original_filename
-        operation['progress'] = 50
-        
-        # Clean up original file
-        os.remove(local_file_path)
-        
-        # Stage 3: Upload to Facebook and store attachment IDs
-        operation['current_stage'] = 'uploading'
-        operation['status'] = 'uploading'
-        
-        # Upload encrypted files and collect attachment IDs
-        upload_results = facebook_service.upload_multiple_files(encrypted_files)
-        
-        # Store attachment IDs for client retrieval
-        attachment_ids = []
-        for result in upload_results:
-            if 'attachment_id' in result:
-                attachment_ids.append(result['attachment_id'])
-        
-        operation['attachment_ids'] = attachment_ids
-        operation['progress'] = 70
+        operations.update(
+            batch_id,
+            current_stage='downloading',
+            status='downloading',
+            progress=10,
+            original_filename=original_filename
+        )
         
-        # Count successful uploads
-        successful_uploads = len(attachment_ids)
+        operation = operations.get(batch_id) or {}
+        # Probed when the job was admitted, so the download does not have to ask again
+        source = operation.get('source') or range_downloader.probe(file_url)
+        validator = source['validator']
+        # The Content-Type tells media and archives apart even when the URL has no extension
+        mime_type = source['content_type'] or None
         
-        # Stage 4: Send messages with batch ID and attachment IDs
-        operation['current_stage'] = 'sending'
-        operation['status'] = 'sending'
+        # A source that was already uploaded goes straight to sending the cached attachments
+        cached = dedup_cache.lookup_url(file_url, validator)
+        if cached and send_cached_segments(batch_id, cached):
+            return
         
-        send_results = []
-        for i, attachment_id in enumerate(attachment_ids):
-            # Send the file with both batch ID and attachment ID in the message
-            message_text = f"Batch: {batch_id}, Attachment: {attachment_id}, Part: {i+1}"
-            send_result = facebook_service.send_attachment_with_message(
-                RECIPIENT_ID,
-                attachment_id, 
-                'file',
-                message_text
-            )
-            send_results.append(send_result)
-            
-            # Small delay to avoid rate limiting
-            time.sleep(1)
+        pipeline, send_results = run_pipeline(batch_id, file_url, source, mime_type, original_filename,
+                                              check_duplicates=not cached)
+        if pipeline.duplicate_of is not None:
+            if send_cached_segments(batch_id, pipeline.duplicate_of):
+                return
+            pipeline, send_results = run_pipeline(batch_id, file_url, source, mime_type, original_filename,
+                                                  check_duplicates=False)
         
         # Count successful sends
         successful_sends = sum(1 for result in send_results if 'error' not in result)
-        operation['progress'] = 90
-        
-        # Clean up encrypted files
-        for encrypted_file in encrypted_files:
-            try:
-                os.remove(encrypted_file)
-            except:
-                pass
         
         if successful_sends == 0:
             error_messages = [r.get('error', 'Unknown error') for r in send_results if 'error' in r]
             raise Exception(f"All file sends failed. Errors: {', '.join(error_messages[:3])}")
         
-        operation['status'] = 'completed'
-        operation['progress'] = 100
+        # The batch is only complete if the client can rebuild every lost segment from parity
+        manifest = pipeline.manifest()
+        missing_parts = manifest['part_count'] - len(pipeline.message_ids)
+        if missing_parts > len(pipeline.parity_message_ids):
+            raise Exception(
+                f"Only {len(pipeline.message_ids)} of {manifest['part_count']} segments and "
+                f"{len(pipeline.parity_message_ids)} parity segments were delivered, the file cannot be rebuilt"
+            )
+        
+        # Clients verify every segment against the manifest and re-fetch only the bad ones
+        send_manifest(batch_id, manifest)
+        
+        # Only a batch whose every segment was uploaded and sent can be reused
+        if successful_sends == len(pipeline.encrypted_files) == len(pipeline.attachment_ids):
+            dedup_cache.store(
+                file_url,
+                validator,
+                pipeline.content_hash,
+                pipeline.attachment_ids,
+                f"enc_{batch_id}",
+                original_filename,
+                manifest
+            )
+        
+        operations.update(
+            batch_id,
+            status='completed',
+            progress=100,
+            part_count=manifest['part_count'],
+            manifest=manifest
+        )
         
         print(f"Operation {batch_id} completed successfully. Sent {successful_sends} files.")
         
     except Exception as e:
-        operation['status'] = 'error'
-        operation['error'] = str(e)
+        operations.update(batch_id, status='error', error=str(e))
         print(f"Operation {batch_id} failed: {e}")
 
+def operation_status_payload(batch_id, operation):
+    """Fields reported to clients about an operation"""
+    return {
+        'status': operation.get('status', 'unknown'),
+        'progress': operation.get('progress', 0),
+        'current_stage': operation.get('current_stage', ''),
+        'encrypted_files': operation.get('encrypted_files', []),
+        'original_filename': operation.get('original_filename', ''),
+        'attachment_ids': operation.get('attachment_ids', []),
+        'message_ids': operation.get('message_ids', []),
+        'parity_message_ids': operation.get('parity_message_ids', []),
+        'part_count': operation.get('part_count', 0),
+        'manifest': operation.get('manifest'),
+        'segment_prefix': operation.get('segment_prefix', f"enc_{batch_id}"),
+        'error': operation.get('error', ''),
+        'version': operation.get('version', 0),
+        'start_time': operation.get('start_time', 0)
+    }
+
 @app.route('/operation_status/<batch_id>')
 def operation_status(batch_id):
     """Get the status of an operation"""
     operation = operations.get(batch_id)
     if operation:
-        return jsonify({
-            'status': operation.get('status', 'unknown'),
-            'progress': operation.get('progress', 0),
-            'current_stage': operation.get('current_stage', ''),
-            'encrypted_files': operation.get('encrypted_files', []),
-            'original_filename': operation.get('original_filename', ''),
-            'attachment_ids': operation.get('attachment_ids', []),
-            'start_time': operation.get('start_time', 0)
-        })
+        return jsonify(operation_status_payload(batch_id, operation))
     else:
         return jsonify({'error': 'Operation not found'}), 404
 
+@app.route('/operation_events/<batch_id>')
+def operation_events(batch_id):
+    """Stream status changes of an operation as Server-Sent Events"""
+    if operations.get(batch_id) is None:
+        return jsonify({'error': 'Operation not found'}), 404
+    
+    # Event ids are operation versions, so a reconnecting client only receives newer changes
+    try:
+        last_version = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        last_version = 0
+    
+    def stream():
+        version = last_version
+        while True:
+            operation = operations.wait_for_change(batch_id, version, timeout=STATUS_STREAM_HEARTBEAT)
+            if operation is None:
+                yield "event: gone\ndata: {}\n\n"
+                return
+            
+            # Comment lines keep proxies and the client's read timeout from closing an idle stream
+            if operation.get('version') == version:
+                yield ": keep-alive\n\n"
+                continue
+            
+            version = operation.get('version')
+            payload = json.dumps(operation_status_payload(batch_id, operation))
+            yield f"id: {version}\nevent: status\ndata: {payload}\n\n"
+            
+            if operation.get('status') in TERMINAL_STATUSES:
+                return
+    
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream(), mimetype='text/event-stream', headers=headers)
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=9999)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=9999, threaded=True)
\ No newline at end of file
@@ -0,0 +1,91 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qs
+
+# Returned by a respond() hook to let a call succeed normally
+DEFAULT = object()
+
+class MockGraph:
+    """Local stand-in for the Graph API batch endpoint.
+
+    Every batch request is recorded in `batches` (the decoded list of calls)
+    and every call that ran in `executed`. `batch_statuses` holds HTTP
+    statuses to answer whole batch requests with before behaving normally,
+    and `respond(call, attempt)` returns a batch item, None for a null item
+    or DEFAULT for the normal 200 response; attempt counts how often that
+    call was seen. A call whose depends_on did not succeed in the same
+    batch does not run, as on Graph.
+    """
+
+    def __init__(self, respond: Optional[Callable[[Dict[str, Any], int], Any]] = None):
+        self.respond = respond
+        self.batch_statuses: List[int] = []
+        self.batches: List[List[Dict[str, Any]]] = []
+        self.executed: List[Dict[str, Any]] = []
+        self.attempts: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run_batch(self, calls: List[Dict[str, Any]]) -> Any:
+        with self.lock:
+            self.batches.append(calls)
+            if self.batch_statuses:
+                return self.batch_statuses.pop(0)
+
+            items = []
+            succeeded = set()
+            for call in calls:
+                key = call['relative_url'] + call.get('body', '')
+                attempt = self.attempts[key] = self.attempts.get(key, 0) + 1
+                if call.get('depends_on') and call['depends_on'] not in succeeded:
+                    items.append(item(400, {'error': {'message': 'Dependency failed', 'code': 1}}))
+                    continue
+
+                response = self.respond(call, attempt) if self.respond else DEFAULT
+                if response is DEFAULT:
+                    response = item(200, {'message_id': f'm_{len(self.executed)}', 'url': call['relative_url']})
+                if response is not None and response['code'] == 200:
+                    self.executed.append(call)
+                    if call.get('name'):
+                        succeeded.add(call['name'])
+                items.append(response)
+            return items
+
+    def _handler(self):
+        graph = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                form = parse_qs(self.rfile.read(length).decode())
+                result = graph.run_batch(json.loads(form['batch'][0]))
+                if isinstance(result, int):
+                    self.send_response(result)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                payload = json.dumps(result).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+def item(code: int, body: Any) -> Dict[str, Any]:
+    """A batch item as Graph returns it"""
+    return {'code': code, 'headers': [], 'body': json.dumps(body)}
+
+THROTTLED_ITEM = item(400, {'error': {'message': 'Calls to this api have exceeded the rate limit.', 'code': 613}})
@@ -0,0 +1,53 @@
+import os
+import shutil
+
+import pytest
+
+from client import FileDecryptor
+from server import FileEncryptor
+
+PASSWORD = 'test-password'
+BLOCK_SIZE = 65536
+
+def encrypt(tmp_path, name, data, chunk_size=100000):
+    encryptor = FileEncryptor(chunk_size=chunk_size, buffer_size=BLOCK_SIZE)
+    source = tmp_path / f'{name}.bin'
+    source.write_bytes(data)
+    return encryptor.encrypt_file(str(source), str(tmp_path / f'enc_{name}'), PASSWORD)
+
+@pytest.mark.parametrize('size', [0, 1, BLOCK_SIZE, BLOCK_SIZE + 1])
+def test_round_trip_at_chunk_boundaries(tmp_path, size):
+    original = os.urandom(size)
+    segments = encrypt(tmp_path, 'a', original, chunk_size=70000)
+    assert segments
+
+    output = tmp_path / 'out.bin'
+    assert FileDecryptor().decrypt_file(str(tmp_path / 'enc_a_part*.pdf'), str(output), PASSWORD)
+    assert output.read_bytes() == original
+
+def test_truncated_stream_is_rejected(tmp_path):
+    segments = encrypt(tmp_path, 'a', os.urandom(3 * BLOCK_SIZE), chunk_size=70000)
+    os.remove(segments[-1])
+
+    assert not FileDecryptor().decrypt_file(str(tmp_path / 'enc_a_part*.pdf'), str(tmp_path / 'out.bin'), PASSWORD)
+
+def test_spliced_segment_from_another_file_is_rejected(tmp_path):
+    original = os.urandom(250000)
+    segments = encrypt(tmp_path, 'a', original)
+    foreign = encrypt(tmp_path, 'b', os.urandom(250000))
+    assert len(segments) == len(foreign) > 1
+
+    # Same password, same part index and offset, but a different stream salt
+    shutil.copyfile(foreign[0], segments[0])
+
+    output = tmp_path / 'out.bin'
+    assert not FileDecryptor().decrypt_file(str(tmp_path / 'enc_a_part*.pdf'), str(output), PASSWORD)
+    assert not output.exists() or output.read_bytes() != original
+
+def test_segments_of_one_file_decrypt(tmp_path):
+    original = os.urandom(250000)
+    encrypt(tmp_path, 'a', original)
+
+    output = tmp_path / 'out.bin'
+    assert FileDecryptor().decrypt_file(str(tmp_path / 'enc_a_part*.pdf'), str(output), PASSWORD)
+    assert output.read_bytes() == original
@@ -0,0 +1,77 @@
+import itertools
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from client import FacebookAttachmentDownloader
+from segment_container import file_digest, is_parity_name
+from server import FileEncryptor
+
+PARITY_SEGMENTS = 3
+
+@pytest.fixture(scope='module')
+def batch(tmp_path_factory):
+    """Four data segments (the last one shorter) and three parity segments, with their manifest"""
+    directory = tmp_path_factory.mktemp('batch')
+    source = directory / 'source.bin'
+    source.write_bytes(os.urandom(100000))
+
+    encryptor = FileEncryptor(chunk_size=30000, buffer_size=8192, parity_segments=PARITY_SEGMENTS)
+    files = encryptor.encrypt_file(str(source), str(directory / 'enc_b'), 'password')
+
+    def entry(path):
+        size, sha256 = file_digest(path)
+        return {'name': os.path.basename(path), 'size': size, 'sha256': sha256}
+
+    data_files = [f for f in files if not is_parity_name(f)]
+    parity_files = [f for f in files if is_parity_name(f)]
+    manifest = {
+        'segment_prefix': 'enc_b',
+        'part_count': len(data_files),
+        'parts': [entry(f) for f in data_files],
+        'parity_parts': [entry(f) for f in parity_files],
+    }
+    assert len(data_files) == 4 and len(parity_files) == PARITY_SEGMENTS
+    assert len({os.path.getsize(f) for f in data_files}) > 1
+    return data_files, parity_files, manifest
+
+def rebuild(tmp_path, data_files, parity_files, manifest, lost):
+    """Run the client's rebuild with the parts in lost missing; parity 'downloads' are local copies"""
+    download_path = tmp_path / 'dl'
+    download_path.mkdir(parents=True)
+    downloader = FacebookAttachmentDownloader('token')
+
+    def download_attachment(attachment, path, progress=None, expected=None):
+        return shutil.copy(attachment['source'], os.path.join(path, attachment['name']))
+    downloader.download_attachment = download_attachment
+
+    downloaded = {os.path.basename(f): f for f in data_files if f not in lost}
+    parity = [{'name': os.path.basename(f), 'source': f} for f in parity_files if f not in lost]
+    return downloader.rebuild_segments(manifest, downloaded, parity, str(download_path))
+
+def test_every_loss_of_up_to_k_parts_is_rebuilt(tmp_path, batch):
+    data_files, parity_files, manifest = batch
+    combinations = [
+        lost
+        for count in range(1, PARITY_SEGMENTS + 1)
+        for lost in itertools.combinations(data_files + parity_files, count)
+    ]
+
+    for number, lost in enumerate(combinations):
+        rebuilt = rebuild(tmp_path / str(number), data_files, parity_files, manifest, set(lost))
+
+        lost_data = [f for f in data_files if f in lost]
+        assert sorted(os.path.basename(f) for f in rebuilt) == sorted(os.path.basename(f) for f in lost_data)
+        for original in lost_data:
+            rebuilt_file = next(f for f in rebuilt if os.path.basename(f) == os.path.basename(original))
+            with open(rebuilt_file, 'rb') as a, open(original, 'rb') as b:
+                assert a.read() == b.read(), lost
+
+def test_more_losses_than_parity_cannot_be_rebuilt(tmp_path, batch):
+    data_files, parity_files, manifest = batch
+    lost = set(data_files[:2] + parity_files[:2])
+
+    assert rebuild(tmp_path, data_files, parity_files, manifest, lost) == []
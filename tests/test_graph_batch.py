@@ -0,0 +1,128 @@
+import pytest
+
+from facebook_service import FacebookService
+from graph_batch import execute_batch
+from http_transport import create_session
+from rate_limiter import RateLimiter
+from mock_graph import DEFAULT, THROTTLED_ITEM, MockGraph, item
+
+class NoWaitRateLimiter(RateLimiter):
+    """Counts throttling events instead of backing off, so retries run immediately"""
+
+    def __init__(self):
+        super().__init__({'read': 1000, 'send': 1000})
+        self.throttle_events = 0
+
+    def throttled(self, endpoint, retry_after=None):
+        self.throttle_events += 1
+
+@pytest.fixture
+def graph():
+    mock = MockGraph()
+    yield mock
+    mock.close()
+
+def run(graph, calls, endpoint='read', batch_size=50):
+    limiter = NoWaitRateLimiter()
+    return execute_batch(create_session(), limiter, graph.url, 'token', calls, endpoint, batch_size=batch_size)
+
+def get(n):
+    return {'method': 'GET', 'relative_url': f'm_{n}'}
+
+def post(n, **fields):
+    return dict({'method': 'POST', 'relative_url': 'me/messages', 'body': {'text': f'message {n}'}}, **fields)
+
+def test_calls_are_split_into_batches_and_mapped_in_order(graph):
+    results = run(graph, [get(n) for n in range(120)])
+
+    assert [len(batch) for batch in graph.batches] == [50, 50, 20]
+    assert [result['url'] for result in results] == [f'm_{n}' for n in range(120)]
+
+def test_only_failed_items_are_retried(graph):
+    graph.respond = lambda call, attempt: THROTTLED_ITEM if call['relative_url'] == 'm_3' and attempt == 1 else DEFAULT
+
+    results = run(graph, [get(n) for n in range(5)])
+
+    assert [len(batch) for batch in graph.batches] == [5, 1]
+    assert graph.batches[1][0]['relative_url'] == 'm_3'
+    assert [result['url'] for result in results] == [f'm_{n}' for n in range(5)]
+
+def test_permanent_item_errors_are_not_retried(graph):
+    graph.respond = lambda call, attempt: item(404, {'error': {'message': 'Not found'}}) if call['relative_url'] == 'm_1' else DEFAULT
+
+    results = run(graph, [get(n) for n in range(3)])
+
+    assert len(graph.batches) == 1
+    assert 'error' in results[1] and 'error' not in results[0] and 'error' not in results[2]
+
+def test_incomplete_items_retry_reads_but_not_sends(graph):
+    def respond(call, attempt):
+        if attempt > 1:
+            return DEFAULT
+        if call['relative_url'] == 'm_0':
+            return item(500, {})
+        if call.get('body', '').endswith('1'):
+            return None
+        return DEFAULT
+    graph.respond = respond
+
+    results = run(graph, [get(0), post(1)], endpoint='send')
+
+    assert len(graph.batches) == 2 and graph.batches[1] == [{'method': 'GET', 'relative_url': 'm_0'}]
+    assert 'error' not in results[0]
+    assert 'may already have been executed' in results[1]['error']
+
+def test_whole_batch_server_error_does_not_resend_messages(graph):
+    graph.batch_statuses = [503]
+
+    results = run(graph, [get(0), post(1)], endpoint='send')
+
+    assert len(graph.batches) == 2 and len(graph.batches[1]) == 1
+    assert 'error' not in results[0]
+    assert 'error' in results[1]
+    assert graph.executed == graph.batches[1]
+
+def test_throttled_batch_is_sent_again(graph):
+    graph.batch_statuses = [429]
+
+    results = run(graph, [post(n) for n in range(3)], endpoint='send')
+
+    assert len(graph.batches) == 2
+    assert all('message_id' in result for result in results)
+    assert len(graph.executed) == 3
+
+def test_dependent_call_is_retried_with_its_dependency(graph):
+    graph.respond = lambda call, attempt: THROTTLED_ITEM if call.get('name') == 'text0' and attempt == 1 else DEFAULT
+
+    results = run(graph, [post(0, name='text0'), post(1, depends_on='text0')], endpoint='send')
+
+    assert [len(batch) for batch in graph.batches] == [2, 2]
+    assert [call['body'] for call in graph.executed] == ['text=message+0', 'text=message+1']
+    assert all('message_id' in result for result in results)
+
+def test_message_pairs_are_chained_in_one_batch(graph):
+    service = FacebookService('token', session=create_session())
+    service.base_url = graph.url
+    service.rate_limiter = NoWaitRateLimiter()
+
+    results = service.send_attachments_with_messages('recipient', [(f'a{n}', f'Part: {n}') for n in range(30)])
+
+    # 50 calls per batch, but a text and its attachment are never split
+    assert [len(batch) for batch in graph.batches] == [50, 10]
+    for batch in graph.batches:
+        for text, attachment in zip(batch[0::2], batch[1::2]):
+            assert attachment['depends_on'] == text['name']
+            assert text['omit_response_on_success'] is False
+    assert len(results) == 30 and all('message_id' in result for result in results)
+
+def test_failed_text_keeps_its_attachment_from_being_sent(graph):
+    graph.respond = lambda call, attempt: item(400, {'error': {'message': 'Bad text'}}) if call.get('name') == 'text1' else DEFAULT
+    service = FacebookService('token', session=create_session())
+    service.base_url = graph.url
+    service.rate_limiter = NoWaitRateLimiter()
+
+    results = service.send_attachments_with_messages('recipient', [('a0', 'Part: 1'), ('a1', 'Part: 2')])
+
+    assert 'message_id' in results[0]
+    assert results[1]['error'].startswith('Text message failed')
+    assert len(graph.executed) == 2
@@ -0,0 +1,103 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from client import FacebookAttachmentDownloader
+from segment_container import file_digest, read_manifest, write_manifest
+
+@pytest.fixture
+def file_server():
+    """Serve `files` by path; paths in `corrupt_once` get one bit flipped on their first request"""
+    class Handler(BaseHTTPRequestHandler):
+        files = {}
+        corrupt_once = set()
+        requests = []
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            self.requests.append(path)
+            body = self.files[path]
+            if path in self.corrupt_once:
+                self.corrupt_once.discard(path)
+                body = bytes([body[0] ^ 1]) + body[1:]
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    Handler.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield Handler
+    server.shutdown()
+    server.server_close()
+
+def test_manifest_round_trip(tmp_path):
+    manifest = {
+        'segment_prefix': 'enc_x',
+        'part_count': 1,
+        'parts': [{'name': 'enc_x_part001.pdf', 'size': 3, 'sha256': 'ab' * 32}],
+        'parity_parts': [],
+    }
+    path = str(tmp_path / 'enc_x_manifest.pdf')
+    write_manifest(path, manifest)
+
+    assert read_manifest(path)['parts'] == manifest['parts']
+
+def test_segment_not_matching_the_manifest_is_fetched_again(tmp_path, file_server):
+    segment = tmp_path / 'enc_x_part001.pdf'
+    segment.write_bytes(os.urandom(50000))
+    size, sha256 = file_digest(str(segment))
+    file_server.files['/enc_x_part001.pdf'] = segment.read_bytes()
+    file_server.corrupt_once.add('/enc_x_part001.pdf')
+
+    download_path = tmp_path / 'dl'
+    download_path.mkdir()
+    attachment = {'name': 'enc_x_part001.pdf', 'file_url': file_server.url + '/enc_x_part001.pdf'}
+    expected = {'name': 'enc_x_part001.pdf', 'size': size, 'sha256': sha256}
+
+    file_path = FacebookAttachmentDownloader('token').download_attachment(attachment, str(download_path),
+                                                                          expected=expected)
+
+    assert file_server.requests == ['/enc_x_part001.pdf', '/enc_x_part001.pdf']
+    with open(file_path, 'rb') as f:
+        assert f.read() == segment.read_bytes()
+
+def test_segment_matching_the_manifest_is_fetched_once(tmp_path, file_server):
+    segment = tmp_path / 'enc_x_part001.pdf'
+    segment.write_bytes(os.urandom(50000))
+    size, sha256 = file_digest(str(segment))
+    file_server.files['/enc_x_part001.pdf'] = segment.read_bytes()
+
+    download_path = tmp_path / 'dl'
+    download_path.mkdir()
+    attachment = {'name': 'enc_x_part001.pdf', 'file_url': file_server.url + '/enc_x_part001.pdf'}
+    expected = {'name': 'enc_x_part001.pdf', 'size': size, 'sha256': sha256}
+
+    assert FacebookAttachmentDownloader('token').download_attachment(attachment, str(download_path),
+                                                                     expected=expected)
+    assert file_server.requests == ['/enc_x_part001.pdf']
+
+def test_segments_already_on_disk_are_not_fetched_again(tmp_path, file_server):
+    download_path = tmp_path / 'dl'
+    download_path.mkdir()
+    kept = download_path / 'enc_x_part001.pdf'
+    kept.write_bytes(b'kept')
+    file_server.files['/enc_x_part002.pdf'] = b'fetched'
+    attachments = [
+        {'name': f'enc_x_part00{i}.pdf', 'file_url': f'{file_server.url}/enc_x_part00{i}.pdf'} for i in (1, 2)
+    ]
+    arrived = []
+
+    files = FacebookAttachmentDownloader('token').download_attachments(
+        attachments, str(download_path), arrived.append, existing={'enc_x_part001.pdf': str(kept)}
+    )
+
+    assert file_server.requests == ['/enc_x_part002.pdf']
+    assert files == arrived == [str(download_path / 'enc_x_part002.pdf')]
+    assert kept.read_bytes() == b'kept'